@@ -1,38 +1,427 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, make_response, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from flask.cli import with_appcontext
 from flask_marshmallow import Marshmallow
-from sqlalchemy import func
+from sqlalchemy import Column, MetaData, event, func, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.ext.horizontal_shard import ShardedSession, set_shard_id
+import array
+import atexit
+import base64
+import click
+import codecs
+import collections
+import concurrent.futures
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import json
+import multiprocessing
 import os
+import queue
 import random
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
 
-# Init app
-app = Flask(__name__)
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # base directory
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-# Database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'db.sqlite')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Init the Database
-db = SQLAlchemy(app)
+# Default settings, create_app(config) can override any of them
+defaultConfig = {
+    # Database
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(basedir, 'db.sqlite'),
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+
+    # Write-behind mode (opt-in): single-row inserts are queued and group committed by one writer thread
+    'WRITE_BEHIND': os.environ.get('WRITE_BEHIND', '0') == '1',
+    'WRITE_BEHIND_QUEUE_SIZE': int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 10000)),
+    'WRITE_BEHIND_BATCH_ROWS': int(os.environ.get('WRITE_BEHIND_BATCH_ROWS', 500)),
+    'WRITE_BEHIND_BATCH_MS': int(os.environ.get('WRITE_BEHIND_BATCH_MS', 20)),
+    'WRITE_BEHIND_PUT_TIMEOUT': float(os.environ.get('WRITE_BEHIND_PUT_TIMEOUT', 1.0)),
+    'WRITE_BEHIND_WAIT_TIMEOUT': float(os.environ.get('WRITE_BEHIND_WAIT_TIMEOUT', 10.0)),
+
+    # Responses smaller than this are sent uncompressed
+    'COMPRESS_MIN_SIZE': int(os.environ.get('COMPRESS_MIN_SIZE', 1024)),
+
+    # Password hashing: scrypt or pbkdf2_sha256, cost 0 means the KDF's default from passwordKdfs (scrypt needs a power of two).
+    # Hashes are derived on PASSWORD_WORKERS processes (0 derives on the request thread), with at most
+    # PASSWORD_MAX_PENDING queued or running; a request that cannot get a slot within PASSWORD_WAIT seconds gets a 503.
+    # Both limits are per app process: under gunicorn -w 8 the default makes 8 hashing processes in all
+    'PASSWORD_KDF': os.environ.get('PASSWORD_KDF', 'scrypt'),
+    'PASSWORD_COST': int(os.environ.get('PASSWORD_COST', 0)),
+    'PASSWORD_WORKERS': int(os.environ.get('PASSWORD_WORKERS', 1)),
+    'PASSWORD_MAX_PENDING': int(os.environ.get('PASSWORD_MAX_PENDING', 64)),
+    'PASSWORD_WAIT': float(os.environ.get('PASSWORD_WAIT', 2.0)),
+
+    # Seconds before company and stock writes made by other processes show up in /market, writes committed in this process are applied by the next /market request
+    'MARKET_REFRESH_SECONDS': float(os.environ.get('MARKET_REFRESH_SECONDS', 1.0)),
+
+    # Changes older than this many seconds are deleted by flask prune-changes, 0 keeps them all
+    'CHANGE_RETENTION_SECONDS': float(os.environ.get('CHANGE_RETENTION_SECONDS', 7 * 24 * 3600)),
+
+    # Sharded mode (opt-in): per-advisor tables are split over this many extra SQLite files, see SHARDING below
+    'SHARDS': int(os.environ.get('SHARDS', 0)),
+    'SHARD_DATABASE_URI': 'sqlite:///' + os.path.join(basedir, 'db-shard{}.sqlite'),
+}
+
+# Session that sends every statement to the database holding its rows: the main database,
+# or in sharded mode the shard(s) picked by chooseShard, identityShards and executeShards
+class RoutingSession(ShardedSession):
+
+    def __init__(self, db, **kwargs):
+        shards = {'main': db.engine}
+        for shard in shardNames():
+            shards[shard] = db.engines[shard]
+        super().__init__(shard_chooser=chooseShard, identity_chooser=identityShards, execute_chooser=executeShards, shards=shards, **kwargs)
+        self._db = db
+        self._model_changes = {}
+
+    # statements that are not about a model (Core inserts, session.connection()) run on the main database unless told otherwise
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kwargs):
+        if shard_id is None and mapper is None:
+            shard_id = 'main'
+        return super().get_bind(mapper, shard_id=shard_id, instance=instance, clause=clause, **kwargs)
+
+# Init the Database, it is bound to the app in create_app
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# SQLite only enforces foreign keys (and their ON DELETE rules) when asked to, once per connection.
+# create_app registers this on the app's own engines
+def enableForeignKeys(connection, connectionRecord):
+    if isinstance(connection, sqlite3.Connection):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
 
 # Init Marshmallow
-marsh = Marshmallow(app)
+marsh = Marshmallow()
+
+# One blueprint per domain, all registered by create_app
+investorRoutes = Blueprint('investor', __name__)
+advisorRoutes = Blueprint('advisor', __name__)
+companyRoutes = Blueprint('company', __name__)
+newsRoutes = Blueprint('news', __name__)
+portfolioRoutes = Blueprint('portfolio', __name__)
+investmentRoutes = Blueprint('investment', __name__)
+reportRoutes = Blueprint('report', __name__)
+bulkRoutes = Blueprint('bulk', __name__, cli_group=None)
+changeRoutes = Blueprint('changes', __name__, cli_group=None)
+accountRoutes = Blueprint('account', __name__, cli_group=None)
+marketRoutes = Blueprint('market', __name__)
+
+################################################################### WRITE-BEHIND QUEUE ########################################################################################
+
+# A row waiting in the queue, the request thread can wait on done to know it was committed
+class PendingWrite:
+
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.error = None
+
+class WriteBehindQueue:
+
+    def __init__(self, app, maxsize, batchRows, batchMs):
+        self.app = app
+        self.pending = queue.Queue(maxsize)
+        self.batchRows = batchRows
+        self.batchSeconds = batchMs / 1000.0
+        self.writer = None
+        self.stopping = False
+        self.lock = threading.Lock()
+
+    # Queue a row, raises queue.Full if the writer cannot keep up within timeout (backpressure)
+    def put(self, row, timeout):
+        self.start()
+        write = PendingWrite(row)
+        self.pending.put(write, timeout=timeout)
+        return write
+
+    # The writer thread is started lazily so forked worker processes each get their own
+    def start(self):
+        with self.lock:
+            if self.writer is None or not self.writer.is_alive():
+                self.stopping = False
+                self.writer = threading.Thread(target=self.run, name='write-behind', daemon=True)
+                self.writer.start()
+
+    def run(self):
+        with self.app.app_context():
+            while not self.stopping:
+                batch = self.nextBatch()
+                if batch:
+                    self.commit(batch)
+            db.session.remove()
+
+    # Collect rows until we have batchRows of them or batchMs has passed since the first one
+    def nextBatch(self):
+        first = self.pending.get()
+        if first is None:
+            self.stopping = True
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.batchSeconds
+        while len(batch) < self.batchRows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                write = self.pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if write is None:
+                self.stopping = True
+                break
+            batch.append(write)
+        return batch
+
+    def commit(self, batch):
+        try:
+            db.session.add_all([write.row for write in batch])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # retry the rows one at a time so a single bad row does not fail the whole group
+            for write in batch:
+                try:
+                    db.session.add(write.row)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    # the client may have been answered 202 already, this log line is the only trace of the lost row
+                    self.app.logger.exception('write-behind insert of %s failed', type(write.row).__name__)
+                    write.error = e
+
+        for write in batch:
+            write.done.set()
+
+    # Flush everything still queued and stop the writer thread
+    def close(self):
+        with self.lock:
+            writer = self.writer
+        if writer is not None and writer.is_alive():
+            self.pending.put(None)
+            writer.join()
+
+# Insert a single row and build the response, either committed inline or handed to the write-behind queue.
+# In write-behind mode the response is 202 unless the client asks to wait for the commit with ?wait=1
+def saveRow(row, schema):
+    if not current_app.config['WRITE_BEHIND']:
+        db.session.add(row)
+        db.session.commit()
+        return schema.jsonify(row)
+
+    # serialize before queueing, the writer thread owns the row once it is queued
+    response = schema.jsonify(row)
+    try:
+        write = current_app.extensions['writeQueue'].put(row, current_app.config['WRITE_BEHIND_PUT_TIMEOUT'])
+    except queue.Full:
+        return jsonify(error='write queue is full, retry later'), 503
+
+    if request.args.get('wait') in ('1', 'true'):
+        if not write.done.wait(current_app.config['WRITE_BEHIND_WAIT_TIMEOUT']):
+            return jsonify(error='write was not committed in time, it may still be'), 504
+        if isinstance(write.error, IntegrityError):
+            return jsonify(error='row conflicts with an existing row or references a missing one'), 409
+        if write.error is not None:
+            return jsonify(error='write failed'), 500
+    else:
+        response.status_code = 202
+    return response
+
+################################################################### CONDITIONAL GET / COMPRESSION ###########################################################################
+# Each table has a version counter that is bumped in the same transaction as any write to it.
+# GET handlers decorated with @conditional('entity', ...) (entity names as in bulkEntities) answer with
+# an ETag built from those versions, and a matching If-None-Match gets a 304 before the handler runs its query.
+
+class Table_Version(db.Model):
+    tableName = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+
+def bumpVersions(connection, tables):
+    versions = Table_Version.__table__
+    for table in sorted(tables):
+        updated = connection.execute(versions.update().\
+                where(versions.c.tableName == table).\
+                values(version=versions.c.version + 1))
+        if updated.rowcount == 0:
+            # start from the clock so a recreated database does not hand out ETags clients already cached
+            connection.execute(versions.insert().values(tableName=table, version=int(time.time() * 1000)))
+
+# Tables whose rows the database deletes or updates through ON DELETE rules when a row of table is deleted
+@functools.lru_cache(maxsize=None)
+def cascadeTables(table):
+    tables = set()
+    for child in db.metadata.tables.values():
+        for foreignKey in child.foreign_keys:
+            if foreignKey.column.table.name == table and foreignKey.ondelete in ('CASCADE', 'SET NULL') and child.name not in tables:
+                tables.add(child.name)
+                if foreignKey.ondelete == 'CASCADE':
+                    tables |= cascadeTables(child.name)
+    return frozenset(tables)
+
+# Tables whose rows the database updates through ON UPDATE rules when the column of table is changed
+@functools.lru_cache(maxsize=None)
+def renameTables(table, column):
+    tables = set()
+    for child in db.metadata.tables.values():
+        for foreignKey in child.foreign_keys:
+            if foreignKey.column.table.name == table and foreignKey.column.key == column and foreignKey.onupdate == 'CASCADE':
+                tables.add(child.name)
+                tables |= renameTables(child.name, foreignKey.parent.key)
+    return frozenset(tables)
+
+def cascadedTables(session, obj):
+    if obj in session.deleted:
+        return cascadeTables(obj.__table__.name)
+    tables = set()
+    for column in obj.__table__.columns:
+        if inspect(obj).attrs[column.key].history.deleted:
+            tables |= renameTables(obj.__table__.name, column.key)
+    return tables
+
+@event.listens_for(db.session, 'after_flush')
+def bumpFlushedVersions(session, flushContext):
+    tables = {}
+    for obj in session.new | session.dirty | session.deleted:
+        tables.setdefault(shardOfObject(obj), set()).add(obj.__table__.name)
+    for obj in session.dirty | session.deleted:
+        for table in cascadedTables(session, obj):
+            # a shared row can cascade into every shard, see cascadeIntoShards
+            for shard in shardsOfTable(table) if shardOfObject(obj) == 'main' else [shardOfObject(obj)]:
+                tables.setdefault(shard, set()).add(table)
+
+    for shard, shardTables in tables.items():
+        shardTables.discard(Table_Version.__tablename__)
+        if shardTables:
+            bumpVersions(session.connection(bind_arguments={'shard_id': shard}), shardTables)
+
+# In sharded mode this reads the versions kept by every shard
+def currentETag(entities):
+    tables = [bulkEntities[entity][0].__tablename__ for entity in entities]
+    versions = db.session.query(Table_Version.tableName, Table_Version.version).\
+            filter(Table_Version.tableName.in_(tables)).\
+            order_by(Table_Version.tableName).all()
+    return '"' + hashlib.sha1(repr([tuple(version) for version in versions]).encode()).hexdigest()[:20] + '"'
+
+encodingSuffixes = ('-gzip', '-br')
+
+# ETags in If-None-Match without quotes or weakness
+def clientETags():
+    tags = set()
+    for tag in request.headers.get('If-None-Match', '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        tags.add(tag.strip('"'))
+    return tags
+
+# ETags in If-None-Match without quotes, weakness or the -gzip/-br suffix added by compression
+def requestETags():
+    tags = set()
+    for tag in clientETags():
+        for suffix in encodingSuffixes:
+            if tag.endswith(suffix):
+                tag = tag[:-len(suffix)]
+        tags.add(tag)
+    return tags
+
+def conditional(*entities):
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = currentETag(entities)
+            if etag.strip('"') in requestETags() or '*' in requestETags():
+                response = Response(status=304)
+                response.headers['ETag'] = etag
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.headers['ETag'] = etag
+            return response
+        return wrapper
+    return decorate
+
+compressibleTypes = ('application/json', 'text/csv', 'application/x-ndjson', 'text/plain')
+
+def negotiateEncoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted.quality('br') > 0 and accepted.quality('br') >= accepted.quality('gzip'):
+        return 'br'
+    if accepted.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+def compressResponse(response):
+    if response.status_code == 304:
+        return notModifiedVariant(response)
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.mimetype not in compressibleTypes or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiateEncoding()
+    data = response.get_data()
+    if encoding is None or len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+
+    # a compressed body is a different representation, so it gets its own strong ETag
+    etag = response.headers.get('ETag')
+    if etag is not None:
+        response.headers['ETag'] = etag[:-1] + '-' + encoding + '"'
+    return response
+
+# A 304 must carry the ETag and Vary of the 200 it validates. The client's matching tag says which encoding
+# it holds, preferring the one it would be sent now when it holds several
+def notModifiedVariant(response):
+    response.vary.add('Accept-Encoding')
+    etag = response.headers.get('ETag')
+    if etag is None or any(etag.strip('"').endswith(suffix) for suffix in encodingSuffixes):
+        return response
+
+    held = [suffix for suffix in ('',) + encodingSuffixes if etag.strip('"') + suffix in clientETags() or '*' in clientETags()]
+    preferred = '-' + negotiateEncoding() if negotiateEncoding() is not None else ''
+    suffix = preferred if preferred in held else (held[0] if held else '')
+    response.headers['ETag'] = etag[:-1] + suffix + '"'
+    return response
 
 ################################################################### INVESTOR CLASS/ENTITY #####################################################################################
 
 class Investor(db.Model):
 
+    __table_args__ = {'sqlite_autoincrement': True}    # ids are never reused, in sharded mode each shard hands them out from its own range
+
     investorId = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
     dateOfBirth = db.Column(db.String(40))
-    advisorId = db.Column(db.Integer, db.ForeignKey('advisor.advisorId'))
+    advisorId = db.Column(db.Integer, db.ForeignKey('advisor.advisorId', ondelete='SET NULL'))
     accountId = db.Column(db.Integer, db.ForeignKey('account.accountId'))
-    investment = db.relationship('Investment', backref='investor', lazy=True)
-    portfolio = db.relationship('Portfolio', backref='investor', lazy=True)
-    survey = db.relationship('Survey', backref='investor', lazy=True)
+    investment = db.relationship('Investment', backref='investor', lazy=True, cascade='all', passive_deletes=True)
+    portfolio = db.relationship('Portfolio', backref='investor', lazy=True, cascade='all', passive_deletes=True)
+    survey = db.relationship('Survey', backref='investor', lazy=True, cascade='all', passive_deletes=True)
 
     def __init__(self, name, dob, advisorId, accountId):
         self.name = name
@@ -52,48 +441,122 @@ investors_schema = InvestorSchema(many=True)  # dealing with many investors
 
 
 # Create an investor
-@app.route('/investor', methods=['POST'])
+@investorRoutes.route('/investor', methods=['POST'])
 def addInvestor():
     name = request.json['name']
     dateOfBirth = request.json['dateOfBirth']
     username = request.json['username']
-    password = request.json['password']
+    password = hashPassword(request.json['password'])
 
     newAccount = Account(username, password, False)
     db.session.add(newAccount)
-    db.session.commit()
+    db.session.flush()
 
-    newInvestor = Investor(name, dateOfBirth, leastBusyAdvisor().advisorId, newAccount.accountId)
+    # the account, the advisor reservation and the investor are committed together,
+    # so a failed signup rolls the reservation back as well
+    accountId = newAccount.accountId
+    advisorId = reserveAdvisor()
+    newInvestor = Investor(name, dateOfBirth, advisorId, accountId)
 
     db.session.add(newInvestor)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        undoSignup(accountId, advisorId)
+        raise
 
     return investor_schema.jsonify(newInvestor)
 
+# In sharded mode the account and the advisor reservation live in the main file and the investor in its shard,
+# and the two files commit one after the other. If the commit fails in between, remove whichever half made it
+def undoSignup(accountId, advisorId):
+    account = Account.query.get(accountId)
+    investors = Investor.query.filter_by(accountId = accountId).all()
+    if account is not None and not investors:
+        db.session.delete(account)
+        releaseAdvisor(advisorId)
+    elif account is None:
+        for investor in investors:
+            db.session.delete(investor)
+    db.session.commit()
+
 #Stored procedure that finds the advisor with the least investors assigned to them
 def leastBusyAdvisor():
-    advisorId = Advisor.query.\
-            with_entities(Advisor.advisorId).\
-            outerjoin(Investor).\
-            group_by(Advisor.advisorId).\
-            order_by(func.count(Investor.investorId)).first()
-    return advisorId
+    advisor = Advisor.query.\
+            with_entities(Advisor.advisorId, Advisor.clientCount).\
+            order_by(Advisor.clientCount, Advisor.advisorId).first()
+    return advisor
+
+# Atomically reserve a client slot on the least busy advisor and return its advisorId.
+# The increment only applies if clientCount is still what we read, so concurrent signups
+# in other threads or processes that picked the same advisor retry with the next one
+def reserveAdvisor():
+    while True:
+        advisor = leastBusyAdvisor()
+        if advisor is None:
+            return None
+
+        reserved = Advisor.query.\
+                filter_by(advisorId = advisor.advisorId, clientCount = advisor.clientCount).\
+                update({Advisor.clientCount: Advisor.clientCount + 1}, synchronize_session=False)
+        if reserved:
+            return advisor.advisorId
+
+# Give back a client slot, used when an investor leaves an advisor
+def releaseAdvisor(advisorId):
+    if advisorId is not None:
+        Advisor.query.\
+                filter(Advisor.advisorId == advisorId, Advisor.clientCount > 0).\
+                update({Advisor.clientCount: Advisor.clientCount - 1}, synchronize_session=False)
+
+# Recompute every advisor's clientCount from the investor table (for databases created before the counter existed).
+# The counts are read first and written per advisor since investors may live in other database files than advisors
+def syncAdvisorLoad():
+    clients = db.session.query(Investor.advisorId, func.count(Investor.investorId)).\
+            group_by(Investor.advisorId).all()
+    Advisor.query.update({Advisor.clientCount: 0}, synchronize_session=False)
+    for advisorId, count in clients:
+        if advisorId is not None:
+            Advisor.query.\
+                    filter_by(advisorId = advisorId).\
+                    update({Advisor.clientCount: Advisor.clientCount + count}, synchronize_session=False)
+    db.session.commit()
+
+# Databases created before the counter existed have no clientCount column, create_all does not add it
+def addClientCountColumn():
+    columns = [column['name'] for column in inspect(db.engine).get_columns(Advisor.__tablename__)]
+    if 'clientCount' in columns:
+        return False
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql('ALTER TABLE advisor ADD COLUMN "clientCount" INTEGER NOT NULL DEFAULT 0')
+    return True
+
+@click.command('sync-advisor-load')
+@with_appcontext
+def syncAdvisorLoadCommand():
+    """Add advisor.clientCount if missing and recount every advisor's clients."""
+    if addClientCountColumn():
+        click.echo('added advisor.clientCount')
+    syncAdvisorLoad()
+    click.echo('recounted clients of %d advisors' % len(Advisor.query.all()))
 
 
 # Get single Investor
-@app.route('/investor/<investorId>', methods=['GET'])
+@investorRoutes.route('/investor/<investorId>', methods=['GET'])
+@conditional('investor')
 def getInvestor(investorId):
     investor = Investor.query.get(investorId)
     return investor_schema.jsonify(investor)
 
 # Update an Investor
-@app.route('/investor/<investorId>', methods=['PUT'])
+@investorRoutes.route('/investor/<investorId>', methods=['PUT'])
 def updateInvestor(investorId):
     investor = Investor.query.get(investorId)
 
     name = request.json['name']
     dateOfBirth = request.json['dateOfBirth']
-    password = request.json['password']
+    password = hashPassword(request.json['password'])
 
     account = Account.query.get(investor.accountId)
 
@@ -106,19 +569,22 @@ def updateInvestor(investorId):
     return investor_schema.jsonify(investor)
 
 # Delete Investor
-@app.route('/investor/<investorId>', methods=['DELETE'])
+@investorRoutes.route('/investor/<investorId>', methods=['DELETE'])
 def deleteInvestor(investorId):
     investor = Investor.query.get(investorId)
 
+    # portfolios, holdings, surveys, investments and reports go with it through ON DELETE CASCADE
+    releaseAdvisor(investor.advisorId)
     db.session.delete(investor)
+    deleteAccount(investor.accountId)
     db.session.commit()
 
     return investor_schema.jsonify(investor)
 
 ############################################################# Survey CLASS ####################################################################################################
 class Survey(db.Model):
-    investorId = db.Column(db.Integer, db.ForeignKey('investor.investorId'), primary_key=True)
-    advisorId = db.Column(db.Integer, db.ForeignKey('advisor.advisorId'))
+    investorId = db.Column(db.Integer, db.ForeignKey('investor.investorId', ondelete='CASCADE'), primary_key=True)
+    advisorId = db.Column(db.Integer, db.ForeignKey('advisor.advisorId', ondelete='SET NULL'))
     riskTolerance = db.Column(db.String(10))
     monthlySaving = db.Column(db.Float)
     cashBurn = db.Column(db.Float)
@@ -143,7 +609,7 @@ class SurveySchema(marsh.Schema):
 survey_schema = SurveySchema()
 surveys_schema = SurveySchema(many=True)
 
-@app.route('/investor/<investorId>/survey', methods=['POST'])
+@investorRoutes.route('/investor/<investorId>/survey', methods=['POST'])
 def addSurvey(investorId):
     rt = request.json['riskTolerance']
     ms = request.json['monthlySavings']
@@ -156,12 +622,10 @@ def addSurvey(investorId):
 
     survey = Survey(investor.investorId, investor.advisorId, rt, ms, cb, debt, ai, poi)
 
-    db.session.add(survey)
-    db.session.commit()
-
-    return survey_schema.jsonify(survey)
+    return saveRow(survey, survey_schema)
 
-@app.route('/investor/<investorId>/survey', methods=['GET'])
+@investorRoutes.route('/investor/<investorId>/survey', methods=['GET'])
+@conditional('survey')
 def getSurvey(investorId):
     survey = Survey.query.get(investorId)
     return survey_schema.jsonify(survey)
@@ -170,7 +634,7 @@ def getSurvey(investorId):
 class Account(db.Model):
     accountId = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True)
-    password = db.Column(db.String(50))
+    password = db.Column(db.String(128))    # a hash from hashPassword, or plaintext in rows older than it
     isAdvisor = db.Column(db.Boolean)
     userInv = db.relationship('Investor', backref='account', lazy=True)
     userAdv = db.relationship('Advisor', backref='account', lazy=True)
@@ -187,13 +651,141 @@ class Account(db.Model):
     account_schema = AccountSchema()
     accounts_schema = AccountSchema(many=True)
 
+# Delete an account with one statement, logged like any other account change
+def deleteAccount(accountId):
+    accounts = db.session.query(Account.accountId, Account.username, Account.isAdvisor).filter_by(accountId = accountId)
+    logBulkChanges('account', 'delete', [Account.account_schema.dump(account._asdict()) for account in accounts])
+    Account.query.filter_by(accountId = accountId).delete(synchronize_session=False)
+
+################################################################### CREDENTIALS ###############################################################################################
+# Passwords are stored as <kdf>$<cost>$<salt>$<key> (salt and key base64) and derived on a process pool, so the
+# tens of milliseconds a KDF takes are spent on another core instead of a request thread. Logging in with a password
+# that is still stored in plaintext, or was hashed with another KDF or cost than configured, stores a new hash.
+
+# Default cost of each KDF: scrypt's n (with r=8, p=1) and pbkdf2's iteration count
+passwordKdfs = {
+    'scrypt': 2 ** 14,
+    'pbkdf2_sha256': 600000,
+}
+
+# scrypt's n must be a power of two, and with r=8 needs 1KB per unit of n, this is the most deriveKey's maxmem allows
+maxScryptCost = 2 ** 15
+
+def isPasswordHash(stored):
+    parts = stored.split('$')
+    return len(parts) == 4 and parts[0] in passwordKdfs
+
+# Runs in the pool's worker processes
+def deriveKey(kdf, password, salt, cost):
+    if kdf == 'scrypt':
+        return hashlib.scrypt(password.encode(), salt=salt, n=cost, r=8, p=1, maxmem=64 * 1024 * 1024, dklen=32)
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, cost)
+
+# Raised when every hashing slot stays taken for PASSWORD_WAIT seconds
+class CredentialsBusy(Exception):
+    pass
+
+class PasswordHasher:
+
+    def __init__(self, kdf, cost, workers, maxPending, wait):
+        if kdf not in passwordKdfs:
+            raise ValueError('unknown PASSWORD_KDF %s, expected one of %s' % (kdf, ', '.join(passwordKdfs)))
+        self.kdf = kdf
+        self.cost = cost or passwordKdfs[kdf]
+        if self.cost < 1:
+            raise ValueError('PASSWORD_COST must be positive, got %d' % self.cost)
+        if kdf == 'scrypt' and (self.cost & (self.cost - 1) or not 2 <= self.cost <= maxScryptCost):
+            raise ValueError('PASSWORD_COST for scrypt must be a power of two from 2 to %d, got %d' % (maxScryptCost, self.cost))
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(maxPending)
+        self.wait = wait
+        self.pool = None
+        self.poolPid = None
+        self.lock = threading.Lock()
+
+    # The pool is started lazily so forked worker processes each get their own
+    def start(self):
+        with self.lock:
+            if self.pool is None or self.poolPid != os.getpid():
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self.poolPid = os.getpid()
+            return self.pool
+
+    def derive(self, kdf, password, salt, cost):
+        if not self.slots.acquire(timeout=self.wait):
+            raise CredentialsBusy()
+        try:
+            if self.workers == 0:
+                return deriveKey(kdf, password, salt, cost)
+            return self.start().submit(deriveKey, kdf, password, salt, cost).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        key = self.derive(self.kdf, password, salt, self.cost)
+        return '$'.join((self.kdf, str(self.cost), base64.b64encode(salt).decode(), base64.b64encode(key).decode()))
+
+    # Returns (matches, needsRehash). stored is None for unknown users, which still costs one derivation
+    # so response times do not tell which usernames exist
+    def verify(self, password, stored):
+        if stored is None:
+            self.derive(self.kdf, password, bytes(16), self.cost)
+            return False, False
+        if not isPasswordHash(stored):
+            return hmac.compare_digest(stored.encode(), password.encode()), True
+
+        kdf, cost, salt, key = stored.split('$')
+        derived = self.derive(kdf, password, base64.b64decode(salt), int(cost))
+        return hmac.compare_digest(derived, base64.b64decode(key)), (kdf, int(cost)) != (self.kdf, self.cost)
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None and self.poolPid == os.getpid():
+                self.pool.shutdown()
+            self.pool = None
+
+def hashPassword(password):
+    return current_app.extensions['passwordHasher'].hash(password)
+
+def credentialsBusy(error):
+    return jsonify(error='too many password checks in progress, retry later'), 503
+
+# Check a username and password, returns the account
+@accountRoutes.route('/login', methods=['POST'])
+def login():
+    username = request.json['username']
+    password = request.json['password']
+
+    account = Account.query.filter_by(username = username).first()
+    matches, needsRehash = current_app.extensions['passwordHasher'].verify(password, account.password if account is not None else None)
+    if not matches:
+        return jsonify(error='invalid username or password'), 401
+
+    if needsRehash:
+        account.password = hashPassword(password)
+        db.session.commit()
+
+    return Account.account_schema.jsonify(account)
+
+@accountRoutes.cli.command('hash-passwords')
+def hashPasswordsCommand():
+    """Hash every password still stored in plaintext."""
+    hasher = current_app.extensions['passwordHasher']
+    accounts = [account for account in Account.query.all() if account.password is not None and not isPasswordHash(account.password)]
+    with concurrent.futures.ThreadPoolExecutor(max(hasher.workers, 1)) as threads:
+        for account, hashed in zip(accounts, threads.map(hasher.hash, [account.password for account in accounts])):
+            account.password = hashed
+    db.session.commit()
+    click.echo('hashed %d plaintext passwords' % len(accounts))
+
 ############################################################# Company CLASS/ENTITY ####################################################################################################
 class Company(db.Model):
     companyName = db.Column(db.String(50), primary_key=True)
     industry = db.Column(db.String(30))
     sharesOutstanding = db.Column(db.Integer)
     marketCap = db.Column(db.Integer)
-    offeredStock = db.relationship('Stock', backref='company', lazy=True)
+    offeredStock = db.relationship('Stock', backref='company', lazy=True, cascade='all', passive_deletes=True)
 
     def __init__(self, name, industry, sot, mc):
         self.companyName = name
@@ -211,7 +803,7 @@ company_schema = CompanySchema()
 companies_schema = CompanySchema(many=True)
 
 # Add a Company to the database
-@app.route('/company', methods=['POST'])
+@companyRoutes.route('/company', methods=['POST'])
 def addCompany():
     companyName = request.json['companyName']
     industry = request.json['industry']
@@ -226,20 +818,22 @@ def addCompany():
     return company_schema.jsonify(newCompany)
 
 # Get a single Company
-@app.route('/company/<companyName>', methods=['GET'])
+@companyRoutes.route('/company/<companyName>', methods=['GET'])
+@conditional('company')
 def getCompany(companyName):
     company = Company.query.get(companyName)
     return company_schema.jsonify(company)
 
 # Get all the companies in the database
-@app.route('/company', methods=['GET'])
+@companyRoutes.route('/company', methods=['GET'])
+@conditional('company')
 def getAllCompanies():
     allCompanies = Company.query.all()
     result = companies_schema.dump(allCompanies)
-    return jsonify(allCompanies)
+    return jsonify(result)
 
 # Update a company
-@app.route('/company/<companyName>', methods=['PUT'])
+@companyRoutes.route('/company/<companyName>', methods=['PUT'])
 def updateCompany(companyName):
     company = Company.query.get(companyName)
 
@@ -257,11 +851,16 @@ def updateCompany(companyName):
     return company_schema.jsonify(company)
 
 # Delete company from the database
-@app.route('/company/<companyName>', methods=['DELETE'])
+@companyRoutes.route('/company/<companyName>', methods=['DELETE'])
 def deleteCompany(companyName):
     company = Company.query.get(companyName)
+    # its stocks go with it, but not while investors hold them or advisors offer the company as an investment option
     db.session.delete(company)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify(error='company %s has stocks held in portfolios or investment options' % companyName), 409
     return company_schema.jsonify(company)
 
 ############################################################# Stock Class ########################################################################################################
@@ -269,9 +868,9 @@ class Stock(db.Model):
     ticker = db.Column(db.String(8), primary_key=True)
     currentPrice = db.Column(db.Float(2))
     targetPrice = db.Column(db.Float(2))
-    companyName = db.Column(db.String(50), db.ForeignKey('company.companyName'))
+    companyName = db.Column(db.String(50), db.ForeignKey('company.companyName', ondelete='CASCADE', onupdate='CASCADE'))
 
-    portfolios = db.relationship('Consists_Of', backref='stock', lazy=True)
+    portfolios = db.relationship('Consists_Of', backref='stock', lazy=True, passive_deletes='all')    # holdings keep a stock from being deleted
 
     def __init__(self, tick, cPrice, tPrice, name):
         self.ticker = tick
@@ -289,7 +888,7 @@ class StockSchema(marsh.Schema):
 stock_schema = StockSchema()
 
 # adding the stock to a company
-@app.route('/company/<companyName>/stock', methods=['POST'])
+@companyRoutes.route('/company/<companyName>/stock', methods=['POST'])
 def addStockToCompany(companyName):
     company = Company.query.get(companyName)
     ticker = request.json['ticker']
@@ -304,7 +903,8 @@ def addStockToCompany(companyName):
     return stock_schema.jsonify(newStock)
 
 # getting the stock of a company
-@app.route('/company/<companyName>/stock/<ticker>', methods=['GET'])
+@companyRoutes.route('/company/<companyName>/stock/<ticker>', methods=['GET'])
+@conditional('stock')
 def getCompanyStock(companyName, ticker):
     stock = Stock.query.get(ticker)
     if stock.companyName != companyName:
@@ -313,7 +913,7 @@ def getCompanyStock(companyName, ticker):
         return stock_schema.jsonify(stock)
 
 # Updating the stock of a company
-@app.route('/company/<companyName>/stock/<ticker>', methods=['PUT'])
+@companyRoutes.route('/company/<companyName>/stock/<ticker>', methods=['PUT'])
 def updateCompanyStock(companyName, ticker):
     stock = Stock.query.get(ticker)
     if companyName == stock.companyName:
@@ -332,12 +932,16 @@ def updateCompanyStock(companyName, ticker):
         return stock_schema.jsonify(False)    # return an empty json since the company names must match, so no record on our database for unmatching company names
 
 # Deleting the stock of a company
-@app.route('/company/<companyName>/stock/<ticker>', methods=['DELETE'])
+@companyRoutes.route('/company/<companyName>/stock/<ticker>', methods=['DELETE'])
 def deleteCompanyStock(companyName, ticker):
     stock = Stock.query.get(ticker)
     if companyName == stock.companyName:
         db.session.delete(stock)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify(error='stock %s is held in portfolios' % ticker), 409
         return stock_schema.jsonify(stock)
     else:
         return stock_schema.jsonify(False)    # return an empty json since the company names must match, so no record on our database for unmatching company names
@@ -369,37 +973,38 @@ multiple_news_schema = NewsSchema(many=True)
 headlines_schema = HeadlineSchema(many=True)
 
 # Adding a news item
-@app.route('/news', methods=['POST'])
+@newsRoutes.route('/news', methods=['POST'])
 def addNewsItem():
     headline = request.json['headline']
     postedDate = request.json['postedDate']
     articleBody = request.json['articleBody']
 
     newNewsItem = News(headline, postedDate, articleBody)
-    db.session.add(newNewsItem)
-    db.session.commit()
-    return news_schema.jsonify(newNewsItem)
+    return saveRow(newNewsItem, news_schema)
 
 # getting a news item
-@app.route('/news/<headline>', methods=['GET'])
+@newsRoutes.route('/news/<headline>', methods=['GET'])
+@conditional('news')
 def getNewsItem(headline):
     newsItem = News.query.get(headline)
     return news_schema.jsonify(newsItem)
 
-@app.route('/news/c:<companyName>', methods=['GET'])
+@newsRoutes.route('/news/c:<companyName>', methods=['GET'])
+@conditional('news')
 def getByCompanyName(companyName):
     headlines = News.query.with_entities(News.headline).filter(News.headline.ilike('%' + companyName + '%'))
     result = headlines_schema.jsonify(headlines)
     return jsonify(articles=result.get_json())
 
-@app.route('/news/t:<ticker>', methods=['GET'])
+@newsRoutes.route('/news/t:<ticker>', methods=['GET'])
+@conditional('news')
 def getByTicker(ticker):
     headlines = News.query.with_entities(News.headline).filter(News.headline.like('%' + ticker + '%'))
     result = headlines_schema.jsonify(headlines)
     return jsonify(articles=result.get_json())
 
 # deleting a News item
-@app.route('/news/<headline>', methods=['DELETE'])
+@newsRoutes.route('/news/<headline>', methods=['DELETE'])
 def deleteNewsItem(headline):
     newsItem = News.query.get(headline)
     db.session.delete(newsItem)
@@ -411,15 +1016,17 @@ def deleteNewsItem(headline):
 ############################################################# Portfolio Class ####################################################################################################
 class Portfolio(db.Model):
 
+    __table_args__ = {'sqlite_autoincrement': True}
+
     portfolioId = db.Column(db.Integer, primary_key=True)
     value = db.Column(db.Float, nullable=True)
-    investorId = db.Column(db.Integer, db.ForeignKey('investor.investorId'))
+    investorId = db.Column(db.Integer, db.ForeignKey('investor.investorId', ondelete='CASCADE'))
 
-    bonds = db.relationship('Portfolio_Bond', backref='portfolio', lazy=True)
-    canadianEquities = db.relationship('Portfolio_Canadian_Equity', backref='portfolio', lazy=True)
-    usEquities = db.relationship('Portfolio_US_Equity', backref='portfolio', lazy=True)
+    bonds = db.relationship('Portfolio_Bond', backref='portfolio', lazy=True, cascade='all', passive_deletes=True)
+    canadianEquities = db.relationship('Portfolio_Canadian_Equity', backref='portfolio', lazy=True, cascade='all', passive_deletes=True)
+    usEquities = db.relationship('Portfolio_US_Equity', backref='portfolio', lazy=True, cascade='all', passive_deletes=True)
 
-    stocks = db.relationship('Consists_Of', backref='portfolio', lazy=True)
+    stocks = db.relationship('Consists_Of', backref='portfolio', lazy=True, cascade='all', passive_deletes=True)
 
     def __init__(self, investorId):
         self.investorId = investorId
@@ -438,7 +1045,7 @@ portfolios_schema = PortfolioSchema(many=True)
 
 # Create a portfolio
 
-@app.route('/portfolio', methods=['POST'])
+@portfolioRoutes.route('/portfolio', methods=['POST'])
 def addPortfolio():
     investorId = request.json['investorId']
     bonds = request.json['bonds']
@@ -474,36 +1081,37 @@ def addPortfolio():
 
     return portfolio_schema.jsonify(newPortfolio)
 
-@app.route('/portfolio/id:<portfolioId>', methods=['GET'])
+@portfolioRoutes.route('/portfolio/id:<portfolioId>', methods=['GET'])
+@conditional('portfolio')
 def getPortfolio(portfolioId):
     portfolio = Portfolio.query.get(portfolioId)
     return portfolio_schema.jsonify(portfolio)
 
-@app.route('/portfolio/<investorId>', methods=['GET'])
+@portfolioRoutes.route('/portfolio/<investorId>', methods=['GET'])
+@conditional('portfolio')
 def getAccountPortfolios(investorId):
     portfolios = Portfolio.query.filter_by(investorId = investorId).all()
     result = portfolios_schema.jsonify(portfolios)
     return jsonify(portfolios=result.get_json())
 
-@app.route('/portfolio/<portfolioId>', methods = ['DELETE'])
+@portfolioRoutes.route('/portfolio/<portfolioId>', methods = ['DELETE'])
 def deletePortfolio(portfolioId):
   portfolio = Portfolio.query.get(portfolioId)
   db.session.delete(portfolio)
   db.session.commit()
   return portfolio_schema.jsonify(portfolio)
 
-@app.route('/portfolio/stock', methods = ['POST'])
+@portfolioRoutes.route('/portfolio/stock', methods = ['POST'])
 def addStockToPortfolio():
     portfolioId = request.json['portfolioId']
     stockTicker = request.json['ticker']
     amount = request.json['amount']
 
     consists_of = Consists_Of(portfolioId, stockTicker, amount)
-    db.session.add(consists_of)
-    db.session.commit()
-    return consists_ofschema.jsonify(consists_of)
+    return saveRow(consists_of, consists_ofschema)
 
-@app.route('/portfolio/stock/<portfolioId>', methods = ['GET'])
+@portfolioRoutes.route('/portfolio/stock/<portfolioId>', methods = ['GET'])
+@conditional('consists_of')
 def getStocks(portfolioId):
     allStocks = Consists_Of.query.filter_by(portfolioId = portfolioId)
     result = consists_ofMschema.jsonify(allStocks)
@@ -513,7 +1121,9 @@ def getStocks(portfolioId):
 
 class Portfolio_Bond(db.Model):
 
-    portfolioId = db.Column(db.Integer, db.ForeignKey('portfolio.portfolioId'))
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    portfolioId = db.Column(db.Integer, db.ForeignKey('portfolio.portfolioId', ondelete='CASCADE'))
     bondId = db.Column(db.Integer, primary_key=True)
     amount = db.Column(db.Float)
 
@@ -534,7 +1144,9 @@ portfolios_bond_schema = Portfolio_BondSchema(many=True)
 
 class Portfolio_Canadian_Equity(db.Model):
 
-    portfolioId = db.Column(db.Integer, db.ForeignKey('portfolio.portfolioId'))
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    portfolioId = db.Column(db.Integer, db.ForeignKey('portfolio.portfolioId', ondelete='CASCADE'))
     canadianEquityId = db.Column(db.Integer, primary_key=True)
     amount = db.Column(db.Float)
 
@@ -556,7 +1168,9 @@ portfolios_Canadian_Equity_schema = Portfolio_Canadian_EquitySchema(many=True)
 ############################################################# Portfolio US Equity Class ####################################################################################################
 class Portfolio_US_Equity(db.Model):
 
-    portfolioId = db.Column(db.Integer, db.ForeignKey('portfolio.portfolioId'))
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    portfolioId = db.Column(db.Integer, db.ForeignKey('portfolio.portfolioId', ondelete='CASCADE'))
     usEquityId = db.Column(db.Integer, primary_key=True)
     amount = db.Column(db.Float)
 
@@ -577,8 +1191,8 @@ portfolios_US_Equity_schema = Portfolio_US_EquitySchema(many=True)
 
 class Consists_Of(db.Model):
 
-    portfolioId = db.Column(db.Integer, db.ForeignKey('portfolio.portfolioId'), primary_key=True)
-    stockTicker = db.Column(db.String(8), db.ForeignKey('stock.ticker'), primary_key=True)
+    portfolioId = db.Column(db.Integer, db.ForeignKey('portfolio.portfolioId', ondelete='CASCADE'), primary_key=True)
+    stockTicker = db.Column(db.String(8), db.ForeignKey('stock.ticker', ondelete='RESTRICT', onupdate='CASCADE'), primary_key=True)
     numberOfStocks = db.Column(db.Integer)
 
     def __init__(self, portfolioId, stockTicker, numberOfStocks):
@@ -601,10 +1215,10 @@ consists_ofMschema = Consists_OfSchema(many=True)
 class Investment(db.Model):
 
     referenceId = db.Column(db.Integer, primary_key=True)
-    investorId = db.Column(db.Integer, db.ForeignKey('investor.investorId'))
+    investorId = db.Column(db.Integer, db.ForeignKey('investor.investorId', ondelete='CASCADE'))
     holding = db.Column(db.String(50))
     marketValue = db.Column(db.Float)
-    report = db.relationship('Report', backref='investment', lazy=True)
+    report = db.relationship('Report', backref='investment', lazy=True, cascade='all', passive_deletes=True)
 
     def __init__(self, referenceId, investorId, holding, marketValue):
         self.referenceId = referenceId
@@ -623,15 +1237,18 @@ class InvestmentSchema(marsh.Schema):
 investment_schema = InvestmentSchema()
 investments_schema = InvestmentSchema(many=True)
 
-@app.route('/investment/<referenceId>', methods=['GET'])
+@investmentRoutes.route('/investment/<referenceId>', methods=['GET'])
+@conditional('investment')
 def getInvestment(referenceId):
     investment = Investment.query.get(referenceId)
     return investment_schema.jsonify(investment)
 
-@app.route('/investment/invest/<referenceId>', methods=['PUT'])
+@investmentRoutes.route('/investment/invest/<referenceId>', methods=['PUT'])
 def investIn(referenceId):
     investorId = request.json['investorId']
     investmentOption = Investment_Option.query.get(referenceId)
+    if shardOfId(investorId) != shardOfId(investmentOption.referenceId):
+        return jsonify(error='investor %s cannot take options from an advisor on another shard' % investorId), 400
     newInvestment = Investment(referenceId, investorId, investmentOption.companyName, calculateMarketValue(investmentOption))
     db.session.add(newInvestment)
     db.session.delete(investmentOption)
@@ -639,17 +1256,15 @@ def investIn(referenceId):
     return investment_schema.jsonify(newInvestment)
 
 def calculateMarketValue(option):
-    individualValue = Investment_Option.query.\
-            filter_by(referenceId = option.referenceId).\
-            join(Company).\
-            join(Stock).\
+    individualValue = Stock.query.\
+            filter_by(companyName = option.companyName).\
             with_entities(Stock.currentPrice).\
             first()
-    
+
     return individualValue.currentPrice * option.amount
 
 
-@app.route('/investment/<referenceId>', methods=['DELETE'])
+@investmentRoutes.route('/investment/<referenceId>', methods=['DELETE'])
 def deleteInvestment(referenceId):
     investment = Investment.query.get(referenceId)
     db.session.delete(investment)
@@ -658,11 +1273,13 @@ def deleteInvestment(referenceId):
 
 class Investment_Option(db.Model):
 
+    __table_args__ = {'sqlite_autoincrement': True}
+
     referenceId = db.Column(db.Integer, primary_key=True)
-    advisorId = db.Column(db.Integer, db.ForeignKey('advisor.advisorId'))
+    advisorId = db.Column(db.Integer, db.ForeignKey('advisor.advisorId', ondelete='CASCADE'))
     amount = db.Column(db.Integer)
     invType = db.Column(db.String(10))
-    companyName = db.Column(db.String(50), db.ForeignKey('company.companyName'))
+    companyName = db.Column(db.String(50), db.ForeignKey('company.companyName', ondelete='RESTRICT', onupdate='CASCADE'))
 
     def __init__(self, advisorId, amount, invType, company):
         self.advisorId = advisorId
@@ -680,7 +1297,7 @@ class Investment_OptionSchema(marsh.Schema):
 investment_option_schema = Investment_OptionSchema()
 investment_options_schema = Investment_OptionSchema(many=True)
 
-@app.route('/investment/options', methods=['POST'])
+@investmentRoutes.route('/investment/options', methods=['POST'])
 def addInvestment():
     advisorId = request.json['advisorId']
     amount = request.json['amount']
@@ -692,14 +1309,15 @@ def addInvestment():
     db.session.commit()
     return investment_option_schema.jsonify(newInvestmentOption)
 
-@app.route('/investment/options/<advisorId>', methods=['GET'])
+@investmentRoutes.route('/investment/options/<advisorId>', methods=['GET'])
+@conditional('investment_option')
 def getInvestmentOptions(advisorId):
     options = Investment_Option.query.filter_by(advisorId = advisorId).all()
     return investment_options_schema.jsonify(options)
 
 ####################################################### Report CLASS ##############################################################################################
 class Report(db.Model):
-    referenceId = db.Column(db.Integer, db.ForeignKey('investment.referenceId'), primary_key=True)
+    referenceId = db.Column(db.Integer, db.ForeignKey('investment.referenceId', ondelete='CASCADE'), primary_key=True)
     weeklyPerformance = db.Column(db.Float, nullable=True)
     monthlyPerformance = db.Column(db.Float, nullable=True)
     quarterlyPerformance = db.Column(db.Float, nullable=True)
@@ -723,7 +1341,7 @@ class Report_Schema(marsh.Schema):
 report_schema = Report_Schema()
 reports_schema = Report_Schema(many=True)
 
-@app.route('/report', methods=['POST'])
+@reportRoutes.route('/report', methods=['POST'])
 def addReport():
     referenceId = request.json['referenceId']
     wp = request.json['weekly']
@@ -734,17 +1352,16 @@ def addReport():
     sip = request.json['sinceInception']
 
     newReport = Report(referenceId, wp, mp, qp, ap, fyp, sip)
-    db.session.add(newReport)
-    db.session.commit()
 
-    return report_schema.jsonify(newReport)
+    return saveRow(newReport, report_schema)
 
-@app.route('/report/<referenceId>', methods=['GET'])
+@reportRoutes.route('/report/<referenceId>', methods=['GET'])
+@conditional('report')
 def getReport(referenceId):
     report = Report.query.get(referenceId)
     return report_schema.jsonify(report)
 
-@app.route('/report/<referenceId>', methods=['PUT'])
+@reportRoutes.route('/report/<referenceId>', methods=['PUT'])
 def updateReport(referenceId):
     report = Report.query.get(referenceId)
     wp = request.json['weekly']
@@ -768,14 +1385,16 @@ class Advisor(db.Model):
     advisorId = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100))
     accountId = db.Column(db.Integer, db.ForeignKey('account.accountId'))
-    qualifications = db.relationship('Advisor_Qualification', backref='advisor', lazy=True)
-    investmentOptions = db.relationship('Investment_Option', backref='advisor', lazy=True)
-    clients = db.relationship('Investor', backref='advisor', lazy=True)
-    surveys = db.relationship('Survey', backref='advisor', lazy=True)
+    clientCount = db.Column(db.Integer, nullable=False, default=0, server_default='0')    # number of investors assigned, kept by reserveAdvisor/releaseAdvisor
+    qualifications = db.relationship('Advisor_Qualification', backref='advisor', lazy=True, cascade='all', passive_deletes=True)
+    investmentOptions = db.relationship('Investment_Option', backref='advisor', lazy=True, cascade='all', passive_deletes=True)
+    clients = db.relationship('Investor', backref='advisor', lazy=True, passive_deletes=True)    # clients are reassigned by offboardAdvisor, any left over get advisorId NULL
+    surveys = db.relationship('Survey', backref='advisor', lazy=True, passive_deletes=True)
 
     def __init__(self, name, accountId):
         self.name = name
         self.accountId = accountId
+        self.clientCount = 0
 
 # Advisor Schema
 class AdvisorSchema(marsh.Schema):
@@ -789,11 +1408,11 @@ advisors_schema = AdvisorSchema(many=True)
 
 # Add an advisor into the data base
 
-@app.route('/advisor', methods=['POST'])
+@advisorRoutes.route('/advisor', methods=['POST'])
 def addAdvisor():
   name = request.json['name']
   username = request.json['username']
-  password = request.json['password']
+  password = hashPassword(request.json['password'])
   qualifications = request.json['qualifications']
 
   newAccount = Account(username, password, True)
@@ -813,20 +1432,23 @@ def addAdvisor():
   return advisor_schema.jsonify(newAdvisor)
 
 #get a single advisor via advisorId
-@app.route('/advisor/<advisorId>', methods = ['GET'])
+@advisorRoutes.route('/advisor/<advisorId>', methods = ['GET'])
+@conditional('advisor')
 def getAdvisor(advisorId):
   advisor = Advisor.query.get(advisorId)
   return advisor_schema.jsonify(advisor)
 
 #get qualifications of an advisor
-@app.route('/advisor/<advisorId>/qualifications', methods = ['GET'])
+@advisorRoutes.route('/advisor/<advisorId>/qualifications', methods = ['GET'])
+@conditional('advisor_qualification')
 def getAdvisorQualifications(advisorId):
   quals = Advisor_Qualification.query.filter_by(advisorId = advisorId).all()
   res = advisor_qualifications_schema.jsonify(quals)
   return jsonify(qualifications=res.get_json())
 
 #get all advisors
-@app.route('/advisor', methods = ['GET'])
+@advisorRoutes.route('/advisor', methods = ['GET'])
+@conditional('advisor')
 def getAllAdvisors():
   allAdvisors = Advisor.query.all()
   result = advisors_schema.jsonify(allAdvisors)
@@ -834,18 +1456,19 @@ def getAllAdvisors():
 
 # GET/advisor/{advisorId}/investors
 #retrueve the list of investors an advisor is advertising
-@app.route('/advisors/<advisorId>/investors', methods = ['GET'])
+@advisorRoutes.route('/advisors/<advisorId>/investors', methods = ['GET'])
+@conditional('investor', 'advisor')
 def getAdvisedInvestors(advisorId):
-  AdvisedInvestors = Investor.query.filter_by(advisorId = (Advisor.query.get(advisorId))).all()
+  AdvisedInvestors = Investor.query.filter_by(advisorId = advisorId).all()
   result = investors_schema.jsonify(AdvisedInvestors)
   return jsonify(investors=result.get_json())
 
 #update advisors 
-@app.route('/advisor/<advisorId>', methods = ['PUT'])
+@advisorRoutes.route('/advisor/<advisorId>', methods = ['PUT'])
 def updateAdvisor(advisorId):
   advisor = Advisor.query.get(advisorId)
   name = request.json['name']
-  password = request.json['password']
+  password = hashPassword(request.json['password'])
   qualifications = request.json['qualifications']
 
   account = Account.query.get(advisor.accountId)
@@ -862,17 +1485,64 @@ def updateAdvisor(advisorId):
   return advisor_schema.jsonify(advisor)
 
 
-#delete advisor
-@app.route('/advisor/<advisorId>', methods = ['DELETE'])
+#delete advisor, their clients move to ?reassignTo=<advisorId> or to the least busy remaining advisor
+@advisorRoutes.route('/advisor/<advisorId>', methods = ['DELETE'])
 def deleteAdvisor(advisorId):
   advisor = Advisor.query.get(advisorId)
+  reassignTo = request.args.get('reassignTo', type=int)
+  if reassignTo is not None and (reassignTo == advisor.advisorId or Advisor.query.get(reassignTo) is None):
+      return jsonify(error='cannot reassign clients to advisor %d' % reassignTo), 400
+  if reassignTo is not None and shardOfAdvisor(reassignTo) != shardOfAdvisor(advisor.advisorId):
+      return jsonify(error='advisor %d is on another shard' % reassignTo), 400
+  # clients cannot follow an advisor to another shard, so rather than leaving them without one while
+  # other advisors exist, refuse until an advisor is added to this shard or the clients are deleted
+  if reassignTo is None and replacementAdvisor(advisor) is None and \
+          Advisor.query.filter(Advisor.advisorId != advisor.advisorId).first() is not None and \
+          Investor.query.filter_by(advisorId = advisor.advisorId).first() is not None:
+      return jsonify(error='no other advisor on %s can take the clients of advisor %d' % (shardOfAdvisor(advisor.advisorId), advisor.advisorId)), 409
+
+  offboardAdvisor(advisor, reassignTo)
   db.session.delete(advisor)
+  deleteAccount(advisor.accountId)
   db.session.commit()
-  return advisor_schema.jsonify(advisor)    
+  return advisor_schema.jsonify(advisor)
+
+# The least busy of the other advisors (on the same shard in sharded mode), or None
+def replacementAdvisor(advisor):
+  candidates = Advisor.query.filter(Advisor.advisorId != advisor.advisorId)
+  if current_app.config['SHARDS']:
+      candidates = candidates.filter(Advisor.advisorId % current_app.config['SHARDS'] == advisor.advisorId % current_app.config['SHARDS'])
+  target = candidates.\
+          with_entities(Advisor.advisorId).\
+          order_by(Advisor.clientCount, Advisor.advisorId).first()
+  return target.advisorId if target is not None else None
+
+# Move every client of an advisor, and their surveys, to another advisor with one UPDATE per table.
+# Without toAdvisorId the clients go to replacementAdvisor
+def offboardAdvisor(advisor, toAdvisorId=None):
+  if toAdvisorId is None:
+      toAdvisorId = replacementAdvisor(advisor)
+
+  for entity in ('investor', 'survey'):
+      model = bulkEntities[entity][0]
+      fields = bulkFields(entity)
+      moved = [dict(zip(fields, row)) for row in db.session.query(*[getattr(model, field) for field in fields]).\
+              filter(model.advisorId == advisor.advisorId)]
+      model.query.\
+              filter(model.advisorId == advisor.advisorId).\
+              update({model.advisorId: toAdvisorId}, synchronize_session=False)
+      for row in moved:
+          row['advisorId'] = toAdvisorId
+      logBulkChanges(entity, 'update', moved)
+
+      if model is Investor and toAdvisorId is not None:
+          Advisor.query.\
+                  filter_by(advisorId = toAdvisorId).\
+                  update({Advisor.clientCount: Advisor.clientCount + len(moved)}, synchronize_session=False)
 
 ####################################################### ADVISOR Qualification CLASS ##############################################################################################
 class Advisor_Qualification(db.Model):
-    advisorId = db.Column(db.Integer, db.ForeignKey('advisor.advisorId'), primary_key=True)
+    advisorId = db.Column(db.Integer, db.ForeignKey('advisor.advisorId', ondelete='CASCADE'), primary_key=True)
     qualification = db.Column(db.String(50), primary_key=True)
 
     def __init__(self, advisorId, qual):
@@ -887,12 +1557,1060 @@ class Advisor_QualificationSchema(marsh.Schema):
 advisor_qualification_schema = Advisor_QualificationSchema()
 advisor_qualifications_schema = Advisor_QualificationSchema(many=True)
 
-  
+####################################################### BULK IMPORT / EXPORT ##############################################################################################
+# Every entity can be loaded from / dumped to CSV, NDJSON or Parquet (Parquet needs pyarrow installed).
+# Rows are streamed through generators, validated against the schema field lists and inserted in
+# chunks of bulkChunkSize rows, one transaction per chunk. Values must convert to their column's type exactly,
+# primary key fields are required and other missing fields are stored as NULL. Account passwords are never exported, an account
+# import may carry them as hashes in the CREDENTIALS format (accounts without one cannot log in).
+# With foreign keys on, parents go in before the rows that reference them:
+#   account, advisor, advisor_qualification, investor, survey, company, stock, news, portfolio, the holdings
+#   and consists_of, investment, investment_option, report
+#
+#   flask --app app import company companies.csv
+#   flask --app app export stock stocks.ndjson
+#   curl -X POST --data-binary @news.csv 'localhost:5000/bulk/news?format=csv'
+#   curl 'localhost:5000/bulk/investor?format=ndjson'
+
+bulkEntities = {
+    'account': (Account, Account.account_schema),
+    'investor': (Investor, investor_schema),
+    'survey': (Survey, survey_schema),
+    'company': (Company, company_schema),
+    'stock': (Stock, stock_schema),
+    'news': (News, news_schema),
+    'portfolio': (Portfolio, portfolio_schema),
+    'portfolio_bond': (Portfolio_Bond, portfolio_bond_schema),
+    'portfolio_canadian_equity': (Portfolio_Canadian_Equity, portfolio_Canadian_Equity_schema),
+    'portfolio_us_equity': (Portfolio_US_Equity, portfolio_US_Equity_schema),
+    'consists_of': (Consists_Of, consists_ofschema),
+    'investment': (Investment, investment_schema),
+    'investment_option': (Investment_Option, investment_option_schema),
+    'report': (Report, report_schema),
+    'advisor': (Advisor, advisor_schema),
+    'advisor_qualification': (Advisor_Qualification, advisor_qualification_schema),
+}
+
+bulkFormats = ('csv', 'ndjson', 'parquet')
+bulkChunkSize = 5000
+
+# Columns an import may set that are not exported
+bulkImportOnlyFields = {'account': ('password',)}
+
+def bulkFields(entity):
+    return bulkEntities[entity][1].opts.fields
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def formatFromPath(path):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return 'ndjson' if extension in ('json', 'jsonl') else extension
+
+def requireArrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError('the parquet format needs pyarrow, pip install pyarrow')
+    return pyarrow
+
+# Yield one dict per input row, binaryFile must be seekable for parquet
+def readRows(binaryFile, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(codecs.iterdecode(binaryFile, 'utf-8'))
+    elif fmt == 'ndjson':
+        for line in binaryFile:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    elif fmt == 'parquet':
+        pyarrow = requireArrow()
+        for batch in pyarrow.parquet.ParquetFile(binaryFile).iter_batches(batch_size=bulkChunkSize):
+            yield from batch.to_pylist()
+    else:
+        raise ValueError('unknown format ' + str(fmt))
+
+# value as a kind (a column's python type), ValueError unless it converts exactly: 1.9 is not an int, 'maybe' not a bool
+def convertValue(value, kind):
+    if kind is bool:
+        text = value.lower() if isinstance(value, str) else value
+        if text in ('1', 'true', 'yes', 1):
+            return True
+        if text in ('0', 'false', 'no', 0):
+            return False
+        raise ValueError(value)
+    if kind is int and isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    return kind(value)
+
+# Check a row against the schema fields and convert CSV strings to the column types
+def validateRows(entity, rows):
+    model = bulkEntities[entity][0]
+    fields = bulkFields(entity) + bulkImportOnlyFields.get(entity, ())
+    types = {field: model.__table__.columns[field].type.python_type for field in fields}
+
+    for number, row in enumerate(rows, 1):
+        unknown = set(row) - set(fields)
+        if unknown:
+            raise ValueError('row %d: unknown fields %s' % (number, ', '.join(sorted(unknown))))
+
+        values = {}
+        for field in fields:
+            value = row.get(field)
+            if value == '':
+                value = None
+            if value is not None and not isinstance(value, types[field]):
+                try:
+                    value = convertValue(value, types[field])
+                except (TypeError, ValueError):
+                    raise ValueError('row %d: %s=%r is not a valid %s' % (number, field, value, types[field].__name__))
+            values[field] = value
+
+        missing = [column.key for column in model.__mapper__.primary_key if values[column.key] is None]
+        if missing:
+            raise ValueError('row %d: missing primary key field %s' % (number, ', '.join(missing)))
+        if model is Account and values['password'] is not None and not isPasswordHash(values['password']):
+            raise ValueError('row %d: password must be a hash, plaintext passwords are not imported' % number)
+
+        # an id from one shard's range cannot be stored in another shard
+        if isShardedModel(model) and values[shardKeys[model]] is not None and rowShard(model, values) != keyShard(model, values):
+            raise ValueError('row %d: %s is not an id of %s' % (number, model.__mapper__.primary_key[0].key, keyShard(model, values)))
+        yield values
+
+# Insert rows in chunked transactions, returns (rows, seconds). progress(rows, seconds) is called after every chunk
+def importRows(entity, rows, progress=None):
+    model = bulkEntities[entity][0]
+    started = time.monotonic()
+    total = 0
+
+    try:
+        for chunk in chunked(validateRows(entity, rows), bulkChunkSize):
+            for shard, shardRows in groupByShard(model, chunk).items():
+                db.session.execute(model.__table__.insert(), shardRows, bind_arguments={'shard_id': shard})
+            logBulkChanges(entity, 'insert', chunk)
+            db.session.commit()
+            total += len(chunk)
+            if progress is not None:
+                progress(total, time.monotonic() - started)
+    except IntegrityError as e:
+        db.session.rollback()
+        raise ValueError('%d rows imported, the chunk after them was rejected: %s' % (total, e.orig))
+    except Exception:
+        db.session.rollback()
+        raise
+
+    # imported investors bypass reserveAdvisor, so rebuild the advisor load counters
+    if model is Investor:
+        syncAdvisorLoad()
+
+    return total, time.monotonic() - started
+
+# Stream every row of an entity as a dict, bulkChunkSize rows are fetched at a time
+def exportRows(entity):
+    model = bulkEntities[entity][0]
+    fields = bulkFields(entity)
+    query = db.session.query(*[getattr(model, field) for field in fields]).\
+            order_by(*model.__mapper__.primary_key).\
+            yield_per(bulkChunkSize)
+    for row in query:
+        yield dict(zip(fields, row))
+
+# Text chunks of a CSV or NDJSON export
+def exportText(entity, fmt):
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.DictWriter(buffer, bulkFields(entity))
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda row: buffer.write(json.dumps(row) + '\n')
+
+    for row in exportRows(entity):
+        write(row)
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def exportParquet(entity, binaryFile):
+    pyarrow = requireArrow()
+    model = bulkEntities[entity][0]
+    arrowTypes = {int: pyarrow.int64(), float: pyarrow.float64(), str: pyarrow.string(), bool: pyarrow.bool_()}
+    schema = pyarrow.schema([(field, arrowTypes[model.__table__.columns[field].type.python_type]) for field in bulkFields(entity)])
+
+    with pyarrow.parquet.ParquetWriter(binaryFile, schema) as writer:
+        for chunk in chunked(exportRows(entity), bulkChunkSize):
+            writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema))
+
+@bulkRoutes.cli.command('import')
+@click.argument('entity', type=click.Choice(sorted(bulkEntities)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(bulkFormats), help='Input format, guessed from the file extension by default.')
+def importCommand(entity, path, fmt):
+    """Bulk load ENTITY rows from PATH."""
+    fmt = fmt or formatFromPath(path)
+    progress = lambda rows, seconds: click.echo('%s: %d rows, %.0f rows/s' % (entity, rows, rows / max(seconds, 1e-9)), err=True)
+    try:
+        with open(path, 'rb') as binaryFile:
+            rows, seconds = importRows(entity, readRows(binaryFile, fmt), progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo('imported %d %s rows in %.2fs (%.0f rows/s)' % (rows, entity, seconds, rows / max(seconds, 1e-9)))
+
+@bulkRoutes.cli.command('export')
+@click.argument('entity', type=click.Choice(sorted(bulkEntities)))
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(bulkFormats), help='Output format, guessed from the file extension by default.')
+def exportCommand(entity, path, fmt):
+    """Dump all ENTITY rows to PATH."""
+    fmt = fmt or formatFromPath(path)
+    if fmt not in bulkFormats:
+        raise click.ClickException('unknown format ' + fmt)
+    started = time.monotonic()
+    try:
+        if fmt == 'parquet':
+            exportParquet(entity, path)
+        else:
+            with open(path, 'w', newline='', encoding='utf-8') as textFile:
+                for text in exportText(entity, fmt):
+                    textFile.write(text)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo('exported %s to %s in %.2fs' % (entity, path, time.monotonic() - started))
+
+# Bulk load rows of an entity from the request body
+@bulkRoutes.route('/bulk/<entity>', methods=['POST'])
+def bulkImport(entity):
+    fmt = request.args.get('format', 'ndjson')
+    if entity not in bulkEntities:
+        return jsonify(error='unknown entity ' + entity), 404
+
+    body = request.stream
+    if fmt == 'parquet':
+        # parquet readers need to seek to the footer
+        body = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+        while True:
+            block = request.stream.read(1024 * 1024)
+            if not block:
+                break
+            body.write(block)
+        body.seek(0)
+
+    try:
+        rows, seconds = importRows(entity, readRows(body, fmt))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(entity=entity, rows=rows, seconds=seconds, rowsPerSecond=rows / max(seconds, 1e-9))
+
+# Stream all rows of an entity
+@bulkRoutes.route('/bulk/<entity>', methods=['GET'])
+def bulkExport(entity):
+    fmt = request.args.get('format', 'ndjson')
+    if entity not in bulkEntities:
+        return jsonify(error='unknown entity ' + entity), 404
+    if fmt not in bulkFormats:
+        return jsonify(error='unknown format ' + fmt), 400
+
+    if fmt == 'parquet':
+        try:
+            out = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+            exportParquet(entity, out)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        out.seek(0)
+        return send_file(out, mimetype='application/vnd.apache.parquet', download_name=entity + '.parquet')
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(exportText(entity, fmt)), mimetype=mimetype)
+
+
+
+
+####################################################### CHANGE LOG ##############################################################################################
+# Every insert, update and delete of an entity in bulkEntities is appended to the change table from
+# the same flush, so a change is committed if and only if the mutation is. Consumers read the log with
+# GET /changes?since=<changeId>, optionally long polling with &wait=<seconds> or as server-sent events.
+# In sharded mode every shard keeps its own log and since/next hold one changeId per log, comma separated.
+# Internal counters written with query.update() (Advisor.clientCount) are not part of the feed, and
+# rows removed by ON DELETE CASCADE are implied by the delete of their parent rather than logged one by one.
+# flask prune-changes (run it from cron) drops changes older than CHANGE_RETENTION_SECONDS; a consumer whose
+# cursor falls behind the oldest change left has missed changes and must reload from GET /bulk/<entity> first.
+
+class Change(db.Model):
+    changeId = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(30))
+    entityKey = db.Column(db.String(100))
+    op = db.Column(db.String(10))
+    data = db.Column(db.Text)
+    changedAt = db.Column(db.Float)
+
+class ChangeSchema(marsh.Schema):
+    data = marsh.Function(lambda change: json.loads(change.data))
 
+    class Meta:
+        fields = ('changeId', 'entity', 'entityKey', 'op', 'data', 'changedAt')
+
+changes_schema = ChangeSchema(many=True)
+
+changeEntities = {model: entity for entity, (model, schema) in bulkEntities.items()}
+
+# woken on every commit that logged changes so long polls in this process answer right away,
+# pollers in other processes pick changes up within changePollSeconds
+changeSignal = threading.Condition()
+changePollSeconds = 0.5
+
+# entity -> commits in this process that logged changes to it, so in-memory copies can catch up on local writes
+localCommits = collections.Counter()
+
+def changeRow(entity, model, op, data):
+    key = [data.get(column.key) for column in model.__mapper__.primary_key]
+    return {'entity': entity, 'entityKey': json.dumps(key), 'op': op, 'data': json.dumps(data), 'changedAt': time.time()}
+
+# Log rows written with bulk statements, which the after_flush listener does not see
+def logBulkChanges(entity, op, rows):
+    model = bulkEntities[entity][0]
+    for shard, shardRows in groupByShard(model, rows).items():
+        connection = db.session.connection(bind_arguments={'shard_id': shard})
+        connection.execute(Change.__table__.insert(), [changeRow(entity, model, op, row) for row in shardRows])
+        bumpVersions(connection, [model.__tablename__])
+    db.session.info.setdefault('changedEntities', set()).add(entity)
+
+# The primary key obj had before this flush, None if it did not change
+def previousKey(obj):
+    key = {}
+    for column in obj.__mapper__.primary_key:
+        history = inspect(obj).attrs[column.key].history
+        key[column.key] = history.deleted[0] if history.deleted else getattr(obj, column.key)
+    return key if any(inspect(obj).attrs[column.key].history.deleted for column in obj.__mapper__.primary_key) else None
+
+# (shard, change) for every row the database rewrote through ON UPDATE CASCADE when column of table went from old to new.
+# A row whose primary key was rewritten is logged as a delete of its old key and an insert of the new one
+def renameChanges(session, table, column, old, new):
+    changes = []
+    for child in db.metadata.sorted_tables:
+        for foreignKey in child.foreign_keys:
+            if foreignKey.column.table is not table or foreignKey.column.key != column or foreignKey.onupdate != 'CASCADE':
+                continue
+            model = modelOfTable(child)
+            entity = changeEntities.get(model)
+            if entity is not None:
+                for row in session.query(*[getattr(model, column.key) for column in child.columns]).filter(foreignKey.parent == new):
+                    data = bulkEntities[entity][1].dump(row._asdict())
+                    shard = rowShard(model, data)
+                    if foreignKey.parent.primary_key:
+                        changes.append((shard, changeRow(entity, model, 'delete', dict(data, **{foreignKey.parent.key: old}))))
+                        changes.append((shard, changeRow(entity, model, 'insert', data)))
+                    else:
+                        changes.append((shard, changeRow(entity, model, 'update', data)))
+            changes += renameChanges(session, child, foreignKey.parent.key, old, new)
+    return changes
+
+@event.listens_for(db.session, 'after_flush')
+def logChanges(session, flushContext):
+    rows = {}
+    for op, objects in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            entity = changeEntities.get(type(obj))
+            if entity is None:
+                continue
+            if op == 'update' and not session.is_modified(obj, include_collections=False):
+                continue
+            data = bulkEntities[entity][1].dump(obj)
+            rowOp = op
+            oldKey = previousKey(obj) if op == 'update' else None
+            if oldKey is not None:
+                # consumers keyed on the old primary key would otherwise keep a stale row forever
+                rows.setdefault(shardOfObject(obj), []).append(changeRow(entity, type(obj), 'delete', dict(data, **oldKey)))
+                rowOp = 'insert'
+            rows.setdefault(shardOfObject(obj), []).append(changeRow(entity, type(obj), rowOp, data))
+
+    for obj in session.dirty:
+        for column in obj.__table__.columns:
+            history = inspect(obj).attrs[column.key].history
+            if history.deleted and history.added:
+                for shard, change in renameChanges(session, obj.__table__, column.key, history.deleted[0], history.added[0]):
+                    rows.setdefault(shard, []).append(change)
+
+    for shard, shardRows in rows.items():
+        session.connection(bind_arguments={'shard_id': shard}).execute(Change.__table__.insert(), shardRows)
+        session.info.setdefault('changedEntities', set()).update(row['entity'] for row in shardRows)
+
+@event.listens_for(db.session, 'after_commit')
+def signalChanges(session):
+    entities = session.info.pop('changedEntities', None)
+    if entities:
+        with changeSignal:
+            localCommits.update(entities)
+            changeSignal.notify_all()
+
+@event.listens_for(db.session, 'after_rollback')
+def dropChanges(session):
+    session.info.pop('changedEntities', None)
+
+def changeLogs():
+    return ['main'] + shardNames()
+
+# A cursor holds the last changeId read from each change log
+def parseCursor(text):
+    offsets = [int(offset) for offset in str(text).split(',')] if text not in (None, '') else []
+    logs = changeLogs()
+    return (offsets + [0] * len(logs))[:len(logs)]
+
+def formatCursor(cursor):
+    return cursor[0] if len(cursor) == 1 else ','.join(str(offset) for offset in cursor)
+
+def advanceCursor(cursor, changes):
+    cursor = list(cursor)
+    logs = changeLogs()
+    for change in changes:
+        log = logs.index(inspect(change).identity_token)
+        cursor[log] = max(cursor[log], change.changeId)
+    return cursor
+
+# The oldest changes after cursor across all logs, each log is read in changeId order so the cursor never skips a change
+def changesSince(cursor, limit):
+    logs = []
+    for log, since in zip(changeLogs(), cursor):
+        logs.append(Change.query.\
+                options(set_shard_id(log)).\
+                filter(Change.changeId > since).\
+                order_by(Change.changeId).\
+                limit(limit).all())
+    return list(heapq.merge(*logs, key=lambda change: change.changedAt))[:limit]
+
+# Block until changes after cursor exist or wait seconds have passed
+def waitForChanges(cursor, limit, wait):
+    deadline = time.monotonic() + wait
+    while True:
+        changes = changesSince(cursor, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        db.session.rollback()    # end the read so the next poll sees new commits
+        with changeSignal:
+            changeSignal.wait(min(remaining, changePollSeconds))
+
+# Get the changes after an offset
+@changeRoutes.route('/changes', methods=['GET'])
+def getChanges():
+    try:
+        cursor = parseCursor(request.args.get('since', request.headers.get('Last-Event-ID')))
+    except ValueError:
+        return jsonify(error='since must be a changeId, or one changeId per change log separated by commas'), 400
+    limit = max(1, min(request.args.get('limit', 500, type=int), 5000))
+    wait = min(request.args.get('wait', 0, type=float), 60.0)
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return Response(stream_with_context(streamChanges(cursor, limit)), mimetype='text/event-stream')
+
+    changes = waitForChanges(cursor, limit, wait)
+    result = changes_schema.dump(changes)
+    return jsonify(changes=result, next=formatCursor(advanceCursor(cursor, changes)))
+
+def streamChanges(cursor, limit):
+    while True:
+        changes = waitForChanges(cursor, limit, 15.0)
+        if not changes:
+            yield ': keep-alive\n\n'
+            continue
+        for change, data in zip(changes, changes_schema.dump(changes)):
+            cursor = advanceCursor(cursor, [change])
+            yield 'id: %s\nevent: change\ndata: %s\n\n' % (formatCursor(cursor), json.dumps(data))
+
+
+# Delete the changes committed before cutoff from every log and return how many went. The newest change of a log
+# is always kept: SQLite hands out max(changeId) + 1, so emptying a log would reuse ids that cursors already passed
+def pruneChanges(cutoff):
+    pruned = 0
+    for log in changeLogs():
+        newest = db.session.query(func.max(Change.changeId)).options(set_shard_id(log)).scalar()
+        if newest is None:
+            continue
+        result = db.session.execute(Change.__table__.delete().\
+                where(Change.changedAt < cutoff, Change.changeId < newest),
+                bind_arguments={'shard_id': log})
+        pruned += result.rowcount
+    db.session.commit()
+    return pruned
+
+@changeRoutes.cli.command('prune-changes')
+@click.option('--older-than', 'olderThan', type=float, help='Age in seconds, CHANGE_RETENTION_SECONDS by default.')
+def pruneChangesCommand(olderThan):
+    """Delete change log entries older than the retention period."""
+    if olderThan is None:
+        olderThan = current_app.config['CHANGE_RETENTION_SECONDS']
+    if olderThan <= 0:
+        click.echo('change retention is off, nothing pruned')
+        return
+    click.echo('pruned %d changes' % pruneChanges(time.time() - olderThan))
+
+
+####################################################### MARKET SNAPSHOT ##############################################################################################
+# GET /market/snapshot and GET /market/industry/<industry> serve every company with its stocks and per-industry
+# aggregates (company count, total market cap, average upside of currentPrice to targetPrice, and the companies
+# themselves under "rows") from an in-memory copy of the company and stock tables. Responses are JSON (and gzip)
+# bytes built ahead of time. A refresher thread follows the change log: each company or stock change reloads that
+# one company, and only the industries it was or is in are serialized again. Company and stock commits made in this
+# process are applied by the next /market request before it answers, so clients read their own writes; otherwise
+# requests never query the database.
+# Rows are kept in dicts keyed by companyName and ticker, indexed by industry and by company. The column arrays of
+# an industry are only built while it is serialized: every change re-serializes its industry anyway, so columns
+# kept between refreshes would add bookkeeping without saving work.
+
+# The rows of one industry, stored column-wise, and its response body
+class IndustrySlice:
+
+    def __init__(self, industry, companies, stocks, tickersOf):
+        self.industry = industry
+        self.names = sorted(companies)
+        self.marketCaps = array.array('d', [companies[name][2] or 0 for name in self.names])
+        self.tickers = sorted(ticker for name in self.names for ticker in tickersOf.get(name, ()))
+        self.currentPrices = array.array('d', [stocks[ticker][1] or 0 for ticker in self.tickers])
+        self.targetPrices = array.array('d', [stocks[ticker][2] or 0 for ticker in self.tickers])
+
+        upsides = [target / current - 1 for current, target in zip(self.currentPrices, self.targetPrices) if current > 0 and target > 0]
+        self.summary = {
+            'industry': industry,
+            'companies': len(self.names),
+            'stocks': len(self.tickers),
+            'totalMarketCap': sum(self.marketCaps),
+            'averageUpside': sum(upsides) / len(upsides) if upsides else None,
+        }
+
+        offered = {}
+        for ticker in self.tickers:
+            offered.setdefault(stocks[ticker][0], []).append({'ticker': ticker, 'currentPrice': stocks[ticker][1], 'targetPrice': stocks[ticker][2]})
+        rows = []
+        for name in self.names:
+            industry, sharesOutstanding, marketCap = companies[name]
+            rows.append({'companyName': name, 'industry': industry, 'sharesOutstanding': sharesOutstanding, 'marketCap': marketCap,
+                         'stocks': offered.get(name, [])})
+        self.body = MarketBody(json.dumps(dict(self.summary, rows=rows)).encode())
+
+# Pre-serialized response, with its gzip encoding and ETag
+class MarketBody:
+
+    def __init__(self, data):
+        self.data = data
+        self.gzipped = gzip.compress(data, compresslevel=6)
+        self.etag = hashlib.sha1(data).hexdigest()[:20]
+
+class MarketSnapshot:
+
+    def __init__(self, app, refreshSeconds):
+        self.app = app
+        self.refreshSeconds = refreshSeconds
+        self.companies = {}    # companyName -> (industry, sharesOutstanding, marketCap)
+        self.stocks = {}       # ticker -> (companyName, currentPrice, targetPrice)
+        self.tickersOf = {}    # companyName -> set of its tickers
+        self.members = {}      # industry -> set of companyNames
+        self.industries = {}   # industry -> IndustrySlice
+        self.snapshot = None
+        self.cursor = 0
+        self.localCommits = 0    # localCommits['company'] + localCommits['stock'] already applied
+        self.refresher = None
+        self.refresherPid = None
+        self.stopping = False
+        self.lock = threading.Lock()
+
+    # The first request loads the tables, the refresher thread keeps them current from then on
+    def start(self):
+        with self.lock:
+            if self.snapshot is None:
+                self.load()
+            if self.refresher is None or self.refresherPid != os.getpid() or not self.refresher.is_alive():
+                self.stopping = False
+                self.refresher = threading.Thread(target=self.run, name='market-snapshot', daemon=True)
+                self.refresher.start()
+                self.refresherPid = os.getpid()
+
+    def run(self):
+        with self.app.app_context():
+            while not self.stopping:
+                with changeSignal:
+                    changeSignal.wait(self.refreshSeconds)
+                try:
+                    with self.lock:
+                        self.refresh()
+                except Exception:
+                    self.app.logger.exception('market snapshot refresh failed')
+                finally:
+                    db.session.remove()
+
+    def load(self):
+        self.cursor = db.session.query(func.max(Change.changeId)).options(set_shard_id('main')).scalar() or 0
+        self.companies = {}
+        self.stocks = {}
+        self.tickersOf = {}
+        self.members = {}
+        self.industries = {}
+        for company in Company.query:
+            self.addCompany(company)
+        for stock in Stock.query:
+            self.addStock(stock)
+        self.publish(set(self.members))
+
+    def addCompany(self, company):
+        self.companies[company.companyName] = (company.industry, company.sharesOutstanding, company.marketCap)
+        self.members.setdefault(company.industry, set()).add(company.companyName)
+
+    def addStock(self, stock):
+        self.stocks[stock.ticker] = (stock.companyName, stock.currentPrice, stock.targetPrice)
+        self.tickersOf.setdefault(stock.companyName, set()).add(stock.ticker)
+
+    # Forget a company and its stocks, returns the industry it was in
+    def removeCompany(self, name):
+        for ticker in self.tickersOf.pop(name, ()):
+            del self.stocks[ticker]
+        if name not in self.companies:
+            return None
+        industry = self.companies.pop(name)[0]
+        self.members[industry].discard(name)
+        if not self.members[industry]:
+            del self.members[industry]
+        return industry
+
+    # Apply company and stock changes logged since the last refresh, one company at a time
+    def refresh(self):
+        changes = Change.query.\
+                options(set_shard_id('main')).\
+                filter(Change.changeId > self.cursor, Change.entity.in_(('company', 'stock'))).\
+                order_by(Change.changeId).all()
+        if not changes:
+            return
+        self.cursor = changes[-1].changeId
+
+        names = set()
+        for change in changes:
+            data = json.loads(change.data)
+            if change.entity == 'company':
+                names.add(data['companyName'])
+            else:
+                names.add(data['companyName'])
+                if data['ticker'] in self.stocks:
+                    names.add(self.stocks[data['ticker']][0])
+
+        industries = {self.removeCompany(name) for name in names} - {None}
+        for company in Company.query.filter(Company.companyName.in_(names)):
+            self.addCompany(company)
+            industries.add(company.industry)
+        for stock in Stock.query.filter(Stock.companyName.in_(names)):
+            self.addStock(stock)
+
+        self.publish(industries)
+
+    # Rebuild the given industries, then the snapshot body out of every industry's bytes
+    def publish(self, industries):
+        for industry in industries:
+            if industry in self.members:
+                companies = {name: self.companies[name] for name in self.members[industry]}
+                self.industries[industry] = IndustrySlice(industry, companies, self.stocks, self.tickersOf)
+            else:
+                self.industries.pop(industry, None)
+
+        slices = [self.industries[industry] for industry in sorted(self.industries, key=str)]
+        upsides = [summary['averageUpside'] * summary['stocks'] for summary in (piece.summary for piece in slices) if summary['averageUpside'] is not None]
+        rated = sum(piece.summary['stocks'] for piece in slices if piece.summary['averageUpside'] is not None)
+        totals = {
+            'companies': sum(piece.summary['companies'] for piece in slices),
+            'stocks': sum(piece.summary['stocks'] for piece in slices),
+            'totalMarketCap': sum(piece.summary['totalMarketCap'] for piece in slices),
+            'averageUpside': sum(upsides) / rated if rated else None,
+        }
+        self.snapshot = MarketBody(b'{"totals":' + json.dumps(totals).encode() + b',"industries":[' +
+                                   b','.join(piece.body.data for piece in slices) + b']}')
+
+    def body(self, industry=None):
+        if self.snapshot is None or self.refresher is None or self.refresherPid != os.getpid():
+            self.start()
+        committed = localCommits['company'] + localCommits['stock']
+        if committed != self.localCommits:
+            with self.lock:
+                self.refresh()
+                self.localCommits = max(self.localCommits, committed)
+        if industry is None:
+            return self.snapshot
+        piece = self.industries.get(industry)
+        return piece.body if piece is not None else None
+
+    def close(self):
+        refresher = self.refresher
+        if refresher is not None and refresher.is_alive() and self.refresherPid == os.getpid():
+            self.stopping = True
+            with changeSignal:
+                changeSignal.notify_all()
+            refresher.join()
+
+# Send a MarketBody, gzipped if the client takes it, or 304 if the client has it already
+def marketResponse(body):
+    # only gzip is prepared ahead, a client that takes br but not gzip gets the identity body for compressResponse to encode
+    encoding = 'gzip' if request.accept_encodings.quality('gzip') > 0 and len(body.data) >= current_app.config['COMPRESS_MIN_SIZE'] else None
+    etag = '"' + body.etag + ('-gzip' if encoding else '') + '"'
+    if body.etag in requestETags():
+        response = Response(status=304)
+    else:
+        response = Response(body.gzipped if encoding else body.data, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = etag
+    response.vary.add('Accept-Encoding')
+    return response
+
+@marketRoutes.route('/market/snapshot', methods=['GET'])
+def getMarketSnapshot():
+    return marketResponse(current_app.extensions['marketSnapshot'].body())
+
+@marketRoutes.route('/market/industry/<industry>', methods=['GET'])
+def getMarketIndustry(industry):
+    body = current_app.extensions['marketSnapshot'].body(industry)
+    if body is None:
+        return jsonify(error='no companies in industry %s' % industry), 404
+    return marketResponse(body)
+
+
+####################################################### SHARDING ##############################################################################################
+# With SHARDS=N the per-advisor tables (investors, surveys, portfolios and holdings, investments, reports and
+# investment options) move to N more SQLite files. An advisor's rows live in shard advisorId % N, while accounts,
+# advisors, companies, stocks and news stay in the main database. Shard k hands out ids starting at k * shardSpan,
+# so an investorId, portfolioId or referenceId says which shard holds the row and lookups by id or by advisorId
+# go to one shard. Anything else (list queries, exports) runs on every shard and the results are merged.
+# Every shard keeps its own change log and table versions, so writes to different shards never wait on each other.
+# A flush touching several files commits them one after the other, not atomically.
+#
+#   SHARDS=4 flask --app app init-db
+
+shardSpan = 2 ** 40
+
+# The column that decides which shard a new row goes to
+shardKeys = {
+    Investor: 'advisorId',
+    Investment_Option: 'advisorId',
+    Survey: 'investorId',
+    Portfolio: 'investorId',
+    Portfolio_Bond: 'portfolioId',
+    Portfolio_Canadian_Equity: 'portfolioId',
+    Portfolio_US_Equity: 'portfolioId',
+    Consists_Of: 'portfolioId',
+    Investment: 'referenceId',
+    Report: 'referenceId',
+}
+
+# Kept in the main database and in every shard
+replicatedModels = (Change, Table_Version)
+
+# Columns that hold a shard-allocated id
+shardIdColumns = ('investorId', 'portfolioId', 'referenceId', 'bondId', 'canadianEquityId', 'usEquityId')
+
+def shardNames():
+    return ['shard%d' % shard for shard in range(current_app.config['SHARDS'])]
+
+def isShardedModel(model):
+    return current_app.config['SHARDS'] > 0 and model in shardKeys
+
+def shardOfAdvisor(advisorId):
+    if not current_app.config['SHARDS']:
+        return 'main'
+    return 'shard%d' % (int(advisorId or 0) % current_app.config['SHARDS'])
+
+def shardOfId(rowId):
+    if not current_app.config['SHARDS']:
+        return 'main'
+    return 'shard%d' % (int(rowId or 0) // shardSpan)
+
+def shardOfColumn(column, value):
+    return shardOfAdvisor(value) if column == 'advisorId' else shardOfId(value)
+
+def shardsOfTable(table):
+    if any(model.__table__.name == table for model in shardKeys) and current_app.config['SHARDS']:
+        return shardNames()
+    return ['main']
+
+def columnValue(row, column):
+    return row.get(column) if isinstance(row, dict) else getattr(row, column)
+
+# The shard a new row belongs to going by its shard key
+def keyShard(model, row):
+    return shardOfColumn(shardKeys[model], columnValue(row, shardKeys[model]))
+
+# row is a model instance or a dict of column values. Once a row has its id that says where it lives,
+# even if its advisor was deleted or reassigned since
+def rowShard(model, row):
+    if not isShardedModel(model):
+        return 'main'
+    primaryKey = columnValue(row, model.__mapper__.primary_key[0].key)
+    if primaryKey is not None:
+        return shardOfId(primaryKey)
+    return keyShard(model, row)
+
+def groupByShard(model, rows):
+    shards = {}
+    for row in rows:
+        shards.setdefault(rowShard(model, row), []).append(row)
+    return shards
+
+def shardOfObject(obj):
+    return inspect(obj).identity_token or rowShard(type(obj), obj)
+
+def chooseShard(mapper, instance, clause=None, **kwargs):
+    model = mapper.class_ if mapper is not None else None
+    if not isShardedModel(model):
+        return 'main'
+    if instance is None:
+        raise ValueError('%s statements need a shard_id in sharded mode' % model.__name__)
+    return rowShard(model, instance)
+
+# the first primary key column of every sharded table is an id allocated by its shard
+def identityShards(mapper, primaryKey, **kwargs):
+    if not isShardedModel(mapper.class_):
+        return ['main']
+    return [shardOfId(primaryKey[0])]
+
+# column == value terms ANDed together in the WHERE clause of statement, values may be passed as parameters (Query.get does)
+def equalityTerms(statement, parameters):
+    where = getattr(statement, 'whereclause', None)
+    if where is None:
+        return []
+    terms = where.clauses if getattr(where, 'operator', None) is operators.and_ else [where]
+    found = []
+    for term in terms:
+        if getattr(term, 'operator', None) is operators.eq and isinstance(term.left, Column) and isinstance(term.right, BindParameter):
+            found.append((term.left, (parameters or {}).get(term.right.key, term.right.effective_value)))
+    return found
+
+def executeShards(context):
+    mapper = context.bind_mapper
+    model = mapper.class_ if mapper is not None else None
+    if not current_app.config['SHARDS'] or model is None:
+        return ['main']
+    if model in replicatedModels:
+        return changeLogs()
+    if model not in shardKeys:
+        return ['main']
+
+    for column, value in equalityTerms(context.statement, context.parameters):
+        if column.table is model.__table__ and (column.key == 'advisorId' or column.key in shardIdColumns):
+            try:
+                return [shardOfColumn(column.key, value)]
+            except (TypeError, ValueError):
+                break
+    return shardNames()
+
+modelOfTable = lambda table: next((mapper.class_ for mapper in db.Model.registry.mappers if mapper.local_table is table), None)
+
+# ON DELETE / ON UPDATE rules cannot reach from the main database into the shard files,
+# so deletes and key renames of shared rows are repeated on every shard by hand and RESTRICT is checked there
+@event.listens_for(db.session, 'before_flush')
+def cascadeIntoShards(session, flushContext, instances):
+    if not current_app.config['SHARDS']:
+        return
+
+    statements = []
+    for obj in session.deleted:
+        if not isShardedModel(type(obj)):
+            statements += shardDeleteStatements(session, obj.__table__, {column.key: getattr(obj, column.key) for column in obj.__table__.columns})
+    for obj in session.dirty:
+        if not isShardedModel(type(obj)):
+            statements += shardRenameStatements(obj)
+
+    # most flushes touch no shared rows, and opening a connection would make every shard commit with them
+    if not statements:
+        return
+    for shard in shardNames():
+        connection = session.connection(bind_arguments={'shard_id': shard})
+        for statement in statements:
+            connection.execute(statement)
+
+def shardDeleteStatements(session, table, row):
+    statements = []
+    for model in shardKeys:
+        for foreignKey in model.__table__.foreign_keys:
+            if foreignKey.column.table is table:
+                condition = foreignKey.parent == row[foreignKey.column.key]
+                if foreignKey.ondelete == 'CASCADE':
+                    statements.append(model.__table__.delete().where(condition))
+                elif foreignKey.ondelete == 'SET NULL':
+                    statements.append(model.__table__.update().where(condition).values({foreignKey.parent.key: None}))
+                elif foreignKey.ondelete == 'RESTRICT' and session.query(getattr(model, foreignKey.parent.key)).filter(condition).first() is not None:
+                    # what SQLite raises for the same delete within one file
+                    raise IntegrityError('DELETE', row, sqlite3.IntegrityError('FOREIGN KEY constraint failed'))
+
+    # shared rows the main database deletes along with this one take their shard rows with them too
+    for child in db.metadata.sorted_tables:
+        if isShardedModel(modelOfTable(child)):
+            continue
+        for foreignKey in child.foreign_keys:
+            if foreignKey.column.table is table and foreignKey.ondelete == 'CASCADE':
+                for childRow in session.query(*child.columns).filter(foreignKey.parent == row[foreignKey.column.key]):
+                    statements += shardDeleteStatements(session, child, childRow._asdict())
+    return statements
+
+def shardRenameStatements(obj):
+    statements = []
+    for model in shardKeys:
+        for foreignKey in model.__table__.foreign_keys:
+            if foreignKey.column.table is obj.__table__ and foreignKey.onupdate == 'CASCADE':
+                history = inspect(obj).attrs[foreignKey.column.key].history
+                if history.deleted and history.added:
+                    statements.append(model.__table__.update().\
+                            where(foreignKey.parent == history.deleted[0]).\
+                            values({foreignKey.parent.key: history.added[0]}))
+    return statements
+
+# Create the tables. In sharded mode the main database gets the shared tables and each shard the
+# per-advisor ones, without the foreign keys that would point into another file
+def createTables():
+    if not current_app.config['SHARDS']:
+        # db.metadatas is shared by every app, one that had shards leaves their (empty) binds behind
+        db.create_all(bind_key=None)
+        return
+
+    shardModels = list(shardKeys) + list(replicatedModels)
+    db.metadata.create_all(db.engine, tables=[table for table in db.metadata.sorted_tables if modelOfTable(table) not in shardKeys])
+
+    shardMetadata = MetaData()
+    for model in shardModels:
+        model.__table__.to_metadata(shardMetadata)
+    for table in shardMetadata.tables.values():
+        for constraint in list(table.foreign_key_constraints):
+            if constraint.elements[0].target_fullname.split('.')[0] not in shardMetadata.tables:
+                table.constraints.discard(constraint)
+                for foreignKey in constraint.elements:
+                    foreignKey.parent.foreign_keys.discard(foreignKey)
+                    table.foreign_keys.discard(foreignKey)
+
+    for number, shard in enumerate(shardNames()):
+        engine = db.engines[shard]
+        shardMetadata.create_all(engine)
+        with engine.begin() as connection:
+            for table in shardMetadata.tables.values():
+                if table.dialect_options['sqlite']['autoincrement'] and number > 0:
+                    connection.exec_driver_sql('INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? '
+                                               'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)',
+                                               (table.name, number * shardSpan, table.name))
+
+# Rebuild every existing table from the models, keeping the rows of the columns both have. Databases created before
+# the ON DELETE / ON UPDATE rules and advisor.clientCount need this, SQLite cannot ALTER foreign keys in place.
+# Returns the rebuilt tables and the rows whose foreign keys point at nothing
+def migrateTables():
+    rebuilt = []
+    with db.engine.connect() as connection:
+        # only takes effect outside a transaction, and the copies must not trigger cascades
+        connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        connection.commit()
+
+        existing = set(inspect(connection).get_table_names())
+        models = MetaData()
+        for table in db.metadata.sorted_tables:
+            table.to_metadata(models)
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            oldColumns = {column['name'] for column in inspect(connection).get_columns(table.name)}
+            columns = ', '.join('"%s"' % column.name for column in table.columns if column.name in oldColumns)
+            newTable = table.to_metadata(models, name=table.name + '__migrating')
+            newTable.create(connection)
+            connection.exec_driver_sql('INSERT INTO "%s" (%s) SELECT %s FROM "%s"' % (newTable.name, columns, columns, table.name))
+            connection.exec_driver_sql('DROP TABLE "%s"' % table.name)
+            connection.exec_driver_sql('ALTER TABLE "%s" RENAME TO "%s"' % (newTable.name, table.name))
+            rebuilt.append(table.name)
+        orphans = connection.exec_driver_sql('PRAGMA foreign_key_check').fetchall()
+        connection.commit()
+
+        connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+        connection.commit()
+    return rebuilt, orphans
+
+@click.command('init-db')
+@click.option('--migrate', is_flag=True, help='Rebuild existing tables with the current schema, keeping their rows.')
+@with_appcontext
+def initDbCommand(migrate):
+    """Create the database tables (and shard files in sharded mode)."""
+    if migrate:
+        if current_app.config['SHARDS']:
+            raise click.UsageError('migrate the single-file database before turning on SHARDS')
+        rebuilt, orphans = migrateTables()
+        click.echo('rebuilt %d tables: %s' % (len(rebuilt), ', '.join(rebuilt)))
+        for table in sorted({orphan[0] for orphan in orphans}):
+            click.echo('warning: %d rows of %s reference missing rows' % (len([orphan for orphan in orphans if orphan[0] == table]), table))
+
+    createTables()
+    if migrate:
+        syncAdvisorLoad()
+    click.echo('created tables in %d database file(s)' % (1 + current_app.config['SHARDS']))
+
+
+####################################################### APP FACTORY ##############################################################################################
+# Apps made by create_app that are still in use. The exit and fork hooks below are registered once for all of them,
+# so creating an app does not add hooks that keep it alive
+liveApps = weakref.WeakSet()
+
+# flush queued writes and stop the background threads and hashing pools
+def closeApps():
+    for app in list(liveApps):
+        for extension in ('writeQueue', 'marketSnapshot', 'passwordHasher'):
+            app.extensions[extension].close()
+
+# pooled connections must not be shared with forked children, each worker opens its own
+def disposeEngines():
+    for app in list(liveApps):
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+atexit.register(closeApps)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=disposeEngines)
+
+# Importing this module only defines models, schemas and routes. create_app builds the Flask app and binds
+# the extensions, but no database connection is opened until a request needs one, so the app can be created
+# once in a parent process and shared copy-on-write by forked workers:
+#
+#   gunicorn --preload -w 8 'app:create_app()'
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(defaultConfig)
+    if config is not None:
+        app.config.update(config)
+    for shard in range(app.config['SHARDS']):
+        app.config.setdefault('SQLALCHEMY_BINDS', {})['shard%d' % shard] = app.config['SHARD_DATABASE_URI'].format(shard)
+
+    db.init_app(app)
+    marsh.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'connect', enableForeignKeys)
+
+    for blueprint in (investorRoutes, advisorRoutes, companyRoutes, newsRoutes, portfolioRoutes,
+                      investmentRoutes, reportRoutes, bulkRoutes, changeRoutes, accountRoutes, marketRoutes):
+        app.register_blueprint(blueprint)
+    app.after_request(compressResponse)
+    app.cli.add_command(initDbCommand)
+    app.cli.add_command(syncAdvisorLoadCommand)
+    app.register_error_handler(CredentialsBusy, credentialsBusy)
+
+    app.extensions['writeQueue'] = WriteBehindQueue(app, app.config['WRITE_BEHIND_QUEUE_SIZE'], app.config['WRITE_BEHIND_BATCH_ROWS'], app.config['WRITE_BEHIND_BATCH_MS'])
+    app.extensions['passwordHasher'] = PasswordHasher(app.config['PASSWORD_KDF'], app.config['PASSWORD_COST'], app.config['PASSWORD_WORKERS'],
+                                                      app.config['PASSWORD_MAX_PENDING'], app.config['PASSWORD_WAIT'])
+    app.extensions['marketSnapshot'] = MarketSnapshot(app, app.config['MARKET_REFRESH_SECONDS'])
+    liveApps.add(app)
+
+    return app
 
 
 # Run server
 
 if __name__ == '__main__':
 
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,15 @@
+# Runnable benchmarks, each prints its own numbers. Run them from the repository root:
+#   python -m benchmarks.<name>
+import os
+
+import app as appModule
+
+# An app on a fresh SQLite file in directory. Passwords use a cheap KDF unless a benchmark is about them
+def makeApp(directory, **config):
+    settings = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'db.sqlite'),
+                'PASSWORD_WORKERS': 0, 'PASSWORD_KDF': 'pbkdf2_sha256', 'PASSWORD_COST': 1000}
+    settings.update(config)
+    app = appModule.create_app(settings)
+    with app.app_context():
+        appModule.createTables()
+    return app
@@ -0,0 +1,51 @@
+# Bulk import and export throughput in rows/s for each format, with generated company rows
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import app as appModule
+from benchmarks import makeApp
+
+def companies(count):
+    for number in range(count):
+        yield {'companyName': 'company %d' % number, 'industry': 'industry %d' % (number % 20),
+               'sharesOutstanding': number * 10, 'marketCap': number * 100}
+
+def run(fmt, rows):
+    with tempfile.TemporaryDirectory() as directory:
+        os.mkdir(os.path.join(directory, 'source'))
+        os.mkdir(os.path.join(directory, 'target'))
+        source = makeApp(os.path.join(directory, 'source'))
+        with source.app_context():
+            appModule.importRows('company', companies(rows))
+
+            started = time.perf_counter()
+            exported = io.BytesIO()
+            if fmt == 'parquet':
+                appModule.exportParquet('company', exported)
+            else:
+                for text in appModule.exportText('company', fmt):
+                    exported.write(text.encode())
+            exportSeconds = time.perf_counter() - started
+
+        target = makeApp(os.path.join(directory, 'target'))
+        with target.app_context():
+            exported.seek(0)
+            imported, importSeconds = appModule.importRows('company', appModule.readRows(exported, fmt))
+        assert imported == rows
+        print('%-8s export %8.0f rows/s, import %8.0f rows/s, %6.1f MB' % (fmt, rows / exportSeconds, rows / importSeconds, len(exported.getvalue()) / 1e6))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+    for fmt in appModule.bulkFormats:
+        try:
+            run(fmt, args.rows)
+        except ValueError as e:
+            print('%-8s skipped: %s' % (fmt, e))
+
+if __name__ == '__main__':
+    main()
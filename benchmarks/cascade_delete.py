@@ -0,0 +1,40 @@
+# Deleting a portfolio with 12k holdings, then its investor, with the deletes pushed to ON DELETE CASCADE
+import argparse
+import tempfile
+import time
+
+import app as appModule
+from benchmarks import makeApp
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--holdings', type=int, default=4000, help='rows in each of the three holdings tables')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = makeApp(directory)
+        with app.app_context():
+            client = app.test_client()
+            client.post('/advisor', json={'name': 'a', 'username': 'a', 'password': 'p', 'qualifications': []})
+            investorId = client.post('/investor', json={'name': 'i', 'dateOfBirth': 'd', 'username': 'i', 'password': 'p'}).get_json()['investorId']
+            client.post('/investor/%d/survey' % investorId, json={'riskTolerance': 'low', 'monthlySavings': 1, 'cashBurn': 1, 'debt': 1, 'annualIncome': 1, 'preferenceOfIncome': 'x'})
+            holdings = [1.0] * args.holdings
+            for number in range(2):
+                client.post('/portfolio', json={'investorId': investorId, 'bonds': holdings, 'canadianEquities': holdings, 'usEquities': holdings})
+            portfolioId = appModule.Portfolio.query.first().portfolioId
+
+            holdingModels = (appModule.Portfolio_Bond, appModule.Portfolio_Canadian_Equity, appModule.Portfolio_US_Equity)
+            started = time.perf_counter()
+            response = client.delete('/portfolio/%d' % portfolioId)
+            elapsed = time.perf_counter() - started
+            left = sum(len(model.query.filter_by(portfolioId = portfolioId).all()) for model in holdingModels)
+            print('DELETE /portfolio with %d holdings: %d in %.1fms, orphaned holdings: %d' % (3 * args.holdings, response.status_code, elapsed * 1000, left))
+
+            started = time.perf_counter()
+            response = client.delete('/investor/%d' % investorId)
+            elapsed = time.perf_counter() - started
+            left = sum(len(model.query.all()) for model in holdingModels + (appModule.Portfolio, appModule.Survey))
+            print('DELETE /investor with a %d-holding portfolio: %d in %.1fms, orphaned rows: %d' % (3 * args.holdings, response.status_code, elapsed * 1000, left))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Signup and login latency and throughput from concurrent request threads, with password hashing inline or on the
+# process pool, and the latency of an unrelated GET polled meanwhile
+import argparse
+import tempfile
+import threading
+import time
+
+from benchmarks import makeApp
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[int(fraction * (len(samples) - 1))] * 1000
+
+def run(app, label, threads, requests, request):
+    latencies = []
+    probes = []
+    stopping = threading.Event()
+
+    def worker(number):
+        client = app.test_client()
+        with app.app_context():
+            for sequence in range(requests):
+                started = time.perf_counter()
+                response = request(client, 'u%d-%d' % (number, sequence))
+                assert response.status_code == 200, response.data
+                latencies.append(time.perf_counter() - started)
+
+    def prober():
+        client = app.test_client()
+        with app.app_context():
+            while not stopping.is_set():
+                started = time.perf_counter()
+                client.get('/advisor/1')
+                probes.append(time.perf_counter() - started)
+                time.sleep(0.01)
+
+    probe = threading.Thread(target=prober)
+    probe.start()
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stopping.set()
+    probe.join()
+    print('%-22s %5.1f/s  p50 %5.0fms  p95 %5.0fms  | GET /advisor meanwhile p50 %4.0fms p95 %4.0fms' % (
+        label, threads * requests / elapsed, percentile(latencies, .5), percentile(latencies, .95), percentile(probes, .5), percentile(probes, .95)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=25, help='signups, then logins, per thread')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2], help='PASSWORD_WORKERS values to compare, 0 hashes inline')
+    parser.add_argument('--kdf', default='scrypt')
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            app = makeApp(directory, PASSWORD_KDF=args.kdf, PASSWORD_COST=0, PASSWORD_WORKERS=workers)
+            with app.app_context():
+                # also starts the pool, so its startup is not counted
+                app.test_client().post('/advisor', json={'name': 'a', 'username': 'a', 'password': 'p', 'qualifications': []})
+
+            signup = lambda client, username: client.post('/investor', json={'name': 'i', 'dateOfBirth': 'd', 'username': username, 'password': 'secret'})
+            login = lambda client, username: client.post('/login', json={'username': username, 'password': 'secret'})
+            run(app, 'workers=%d signup' % workers, args.threads, args.requests, signup)
+            run(app, 'workers=%d login' % workers, args.threads, args.requests, login)
+            app.extensions['passwordHasher'].close()
+
+if __name__ == '__main__':
+    main()
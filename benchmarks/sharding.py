@@ -0,0 +1,77 @@
+# Portfolio writes from several processes, one investor (and advisor) each, with SHARDS=0 and with the advisors spread over shards.
+# SQLite takes one write lock per file, so the writers only stop queueing behind each other once they land on different files.
+# --fsync-ms holds every commit for that long to stand in for a slow disk
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from sqlalchemy import event
+
+import app as appModule
+from benchmarks import makeApp
+
+def settings(directory, shards):
+    return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'db.sqlite'),
+            'SHARDS': shards, 'SHARD_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'db-shard{}.sqlite')}
+
+# Only a commit that wrote something would wait for the disk, one that just read returns right away
+def slowCommits(app, fsyncMs):
+    def noteWrite(connection, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            connection.info['wrote'] = True
+
+    def commit(connection):
+        if connection.info.pop('wrote', False):
+            time.sleep(fsyncMs / 1000)
+
+    with app.app_context():
+        for engine in appModule.db.engines.values():
+            event.listen(engine, 'before_cursor_execute', noteWrite)
+            event.listen(engine, 'commit', commit)
+            event.listen(engine, 'rollback', lambda connection: connection.info.pop('wrote', None))
+
+def worker(arguments):
+    directory, shards, fsyncMs, investorId, portfolios = arguments
+    app = appModule.create_app(dict(settings(directory, shards), PASSWORD_WORKERS=0))
+    slowCommits(app, fsyncMs)
+    client = app.test_client()
+    holdings = [1.0] * 5
+    errors = 0
+    started = time.time()
+    for number in range(portfolios):
+        response = client.post('/portfolio', json={'investorId': investorId, 'bonds': holdings, 'canadianEquities': holdings, 'usEquities': holdings})
+        errors += response.status_code != 200
+    return errors, started, time.time()
+
+def run(shards, processes, portfolios, fsyncMs):
+    with tempfile.TemporaryDirectory() as directory:
+        app = makeApp(directory, **settings(directory, shards))
+        client = app.test_client()
+        for number in range(processes):
+            client.post('/advisor', json={'name': 'a%d' % number, 'username': 'a%d' % number, 'password': 'p', 'qualifications': []})
+        investors = [client.post('/investor', json={'name': 'i', 'dateOfBirth': 'd', 'username': 'i%d' % number, 'password': 'p'}).get_json()['investorId']
+                     for number in range(processes)]
+
+        # each process times its own requests, so interpreter start-up is left out
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            results = pool.map(worker, [(directory, shards, fsyncMs, investorId, portfolios) for investorId in investors])
+        errors = [result[0] for result in results]
+        elapsed = max(result[2] for result in results) - min(result[1] for result in results)
+        with app.app_context():
+            written = len(appModule.Portfolio.query.all())
+        print('SHARDS=%-2d %6.0f portfolios/s, %d written, %d errors' % (shards, processes * portfolios / elapsed, written, sum(errors)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--portfolios', type=int, default=50, help='portfolios posted by each process')
+    parser.add_argument('--fsync-ms', type=float, default=0, help='extra time every commit holds the write lock')
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 4, 8])
+    args = parser.parse_args()
+    for shards in args.shards:
+        run(shards, args.processes, args.portfolios, args.fsync_ms)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# Single-row insert throughput from concurrent request threads: inline commits, write-behind, and write-behind with ?wait=1
+import argparse
+import tempfile
+import threading
+import time
+
+from benchmarks import makeApp
+
+def run(mode, threads, rows):
+    with tempfile.TemporaryDirectory() as directory:
+        app = makeApp(directory, WRITE_BEHIND=mode != 'inline')
+        query = '?wait=1' if mode == 'write-behind-wait' else ''
+
+        def worker(number):
+            client = app.test_client()
+            for row in range(rows):
+                response = client.post('/news' + query, json={'headline': 'h%d-%d' % (number, row), 'postedDate': 'd', 'articleBody': 'b'})
+                assert response.status_code in (200, 202), response.data
+
+        workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        app.extensions['writeQueue'].close()
+        elapsed = time.perf_counter() - started
+        print('%-18s %6.0f rows/s' % (mode, threads * rows / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--rows', type=int, default=200, help='rows inserted by each thread')
+    args = parser.parse_args()
+    for mode in ('inline', 'write-behind', 'write-behind-wait'):
+        run(mode, args.threads, args.rows)
+
+if __name__ == '__main__':
+    main()
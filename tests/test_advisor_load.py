@@ -0,0 +1,68 @@
+# Advisor assignment under concurrent signups from several processes, and the clientCount migration
+import multiprocessing
+import sqlite3
+import time
+
+import app as appModule
+
+processes = 4
+signupsPerProcess = 25
+advisors = 5
+
+def appConfig(path):
+    # a cheap KDF, the test is about advisor assignment and not password hashing
+    return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(path), 'PASSWORD_WORKERS': 0,
+            'PASSWORD_KDF': 'pbkdf2_sha256', 'PASSWORD_COST': 1000}
+
+def signupWorker(path, worker):
+    app = appModule.create_app(appConfig(path))
+    client = app.test_client()
+    for number in range(signupsPerProcess):
+        response = client.post('/investor', json={'name': 'n', 'dateOfBirth': 'd', 'username': 'u%d-%d' % (worker, number), 'password': 'p'})
+        assert response.status_code == 200, response.data
+
+def testSignupsStayBalancedAcrossProcesses(tmp_path):
+    path = tmp_path / 'db.sqlite'
+    app = appModule.create_app(appConfig(path))
+    with app.app_context():
+        appModule.createTables()
+        for number in range(advisors):
+            app.test_client().post('/advisor', json={'name': 'a%d' % number, 'username': 'a%d' % number, 'password': 'p', 'qualifications': []})
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=signupWorker, args=(path, worker)) for worker in range(processes)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    assert [worker.exitcode for worker in workers] == [0] * processes
+    print('\n%d signups from %d processes: %.0f signups/s' % (processes * signupsPerProcess, processes, processes * signupsPerProcess / elapsed))
+
+    connection = sqlite3.connect(str(path))
+    counts = dict(connection.execute('SELECT "advisorId", count(*) FROM investor GROUP BY "advisorId"').fetchall())
+    clientCounts = dict(connection.execute('SELECT "advisorId", "clientCount" FROM advisor').fetchall())
+    assert sum(counts.values()) == processes * signupsPerProcess
+    assert max(clientCounts.values()) - min(clientCounts.values()) <= 1
+    assert clientCounts == {advisorId: counts.get(advisorId, 0) for advisorId in clientCounts}
+
+def testSyncAdvisorLoadAddsMissingColumn(tmp_path):
+    path = tmp_path / 'db.sqlite'
+    app = appModule.create_app(appConfig(path))
+    with app.app_context():
+        appModule.createTables()
+    # an advisor table from before the counter existed
+    connection = sqlite3.connect(str(path))
+    connection.executescript('''
+        DROP TABLE advisor;
+        CREATE TABLE advisor ("advisorId" INTEGER PRIMARY KEY, name VARCHAR(30), "accountId" INTEGER);
+        INSERT INTO advisor VALUES (1, 'a', NULL), (2, 'b', NULL);
+        INSERT INTO investor ("investorId", name, "advisorId") VALUES (1, 'i', 1), (2, 'j', 1), (3, 'k', 2);
+    ''')
+    connection.close()
+
+    result = app.test_cli_runner().invoke(args=['sync-advisor-load'])
+    assert result.exit_code == 0, result.output
+    assert 'added advisor.clientCount' in result.output
+    assert sqlite3.connect(str(path)).execute('SELECT "advisorId", "clientCount" FROM advisor ORDER BY 1').fetchall() == [(1, 2), (2, 1)]
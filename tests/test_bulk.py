@@ -0,0 +1,108 @@
+# Bulk import and export: seeding a fresh database, formats, validation and chunk rollback
+import json
+
+import pytest
+
+import app as appModule
+
+def makeApp(path):
+    app = appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(path), 'PASSWORD_WORKERS': 0,
+                                'PASSWORD_KDF': 'pbkdf2_sha256', 'PASSWORD_COST': 1000})
+    with app.app_context():
+        appModule.createTables()
+    return app
+
+@pytest.fixture
+def client(tmp_path):
+    app = makeApp(tmp_path / 'db.sqlite')
+    with app.app_context():
+        yield app.test_client()
+
+def ndjson(rows):
+    return ''.join(json.dumps(row) + '\n' for row in rows)
+
+def testAccountsAdvisorsAndInvestorsSeedAFreshDatabase(tmp_path):
+    source = makeApp(tmp_path / 'source.sqlite')
+    exported = {}
+    with source.app_context():
+        client = source.test_client()
+        client.post('/advisor', json={'name': 'a', 'username': 'a', 'password': 'p', 'qualifications': []})
+        client.post('/investor', json={'name': 'i', 'dateOfBirth': 'd', 'username': 'i', 'password': 'p'})
+        for entity in ('account', 'advisor', 'investor'):
+            exported[entity] = client.get('/bulk/%s?format=ndjson' % entity).get_data(as_text=True)
+        hashes = {account.username: account.password for account in appModule.Account.query}
+    assert 'password' not in exported['account']
+
+    target = makeApp(tmp_path / 'target.sqlite')
+    with target.app_context():
+        client = target.test_client()
+        accounts = [dict(json.loads(line), password=hashes[json.loads(line)['username']]) for line in exported['account'].splitlines()]
+        for entity, body in (('account', ndjson(accounts)), ('advisor', exported['advisor']), ('investor', exported['investor'])):
+            response = client.post('/bulk/%s?format=ndjson' % entity, data=body)
+            assert response.status_code == 200, response.get_json()
+            assert client.get('/bulk/%s?format=ndjson' % entity).get_data(as_text=True) == exported[entity]
+        assert client.post('/login', json={'username': 'i', 'password': 'p'}).status_code == 200
+        assert appModule.Advisor.query.one().clientCount == 1
+
+def testAccountImportRejectsPlaintextPasswords(client):
+    response = client.post('/bulk/account?format=ndjson', data=ndjson([{'accountId': 1, 'username': 'u', 'password': 'secret', 'isAdvisor': False}]))
+    assert response.status_code == 400
+    assert 'hash' in response.get_json()['error']
+    assert appModule.Account.query.all() == []
+
+@pytest.mark.parametrize('row, message', [
+    ({'companyName': 'Acme', 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 1.9}, "marketCap=1.9 is not a valid int"),
+    ({'companyName': 'Acme', 'industry': 'tech', 'sharesOutstanding': '1.5', 'marketCap': 2}, "sharesOutstanding='1.5' is not a valid int"),
+    ({'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2}, 'missing primary key field companyName'),
+    ({'companyName': '', 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2}, 'missing primary key field companyName'),
+])
+def testRowsThatDoNotConvertExactlyAreRejected(client, row, message):
+    response = client.post('/bulk/company?format=ndjson', data=ndjson([row]))
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
+    assert appModule.Company.query.all() == []
+
+def testWholeNumbersAndBooleanWordsConvert(client):
+    client.post('/bulk/company?format=ndjson', data=ndjson([{'companyName': 'Acme', 'industry': 'tech', 'sharesOutstanding': 1.0, 'marketCap': '2'}]))
+    assert (appModule.Company.query.one().sharesOutstanding, appModule.Company.query.one().marketCap) == (1, 2)
+
+    assert client.post('/bulk/account?format=csv', data='accountId,username,isAdvisor\n1,u,maybe\n').status_code == 400
+    assert client.post('/bulk/account?format=csv', data='accountId,username,isAdvisor\n1,u,Yes\n2,v,0\n').status_code == 200
+    assert [account.isAdvisor for account in appModule.Account.query.order_by(appModule.Account.accountId)] == [True, False]
+
+def seedRows(client):
+    client.post('/company', json={'companyName': 'Acme, Inc.', 'industry': 'tech', 'sharesOutstanding': 10, 'marketCap': 20})
+    client.post('/company', json={'companyName': 'Bolt', 'industry': None, 'sharesOutstanding': 5, 'marketCap': 7})
+    client.post('/company/Bolt/stock', json={'ticker': 'BLT', 'currentPrice': 1.25, 'targetPrice': 2.5})
+    client.post('/news', json={'headline': 'line\nbreak "quoted"', 'postedDate': '2024-01-01', 'articleBody': 'é'})
+
+@pytest.mark.parametrize('fmt', ['csv', 'ndjson', 'parquet'])
+def testRoundTrip(tmp_path, fmt):
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+    source = makeApp(tmp_path / 'source.sqlite')
+    target = makeApp(tmp_path / 'target.sqlite')
+    with source.app_context():
+        seedRows(source.test_client())
+    for entity in ('company', 'stock', 'news'):
+        with source.app_context():
+            exported = source.test_client().get('/bulk/%s?format=%s' % (entity, fmt)).get_data()
+            expected = list(appModule.exportRows(entity))
+        with target.app_context():
+            response = target.test_client().post('/bulk/%s?format=%s' % (entity, fmt), data=exported)
+            assert response.status_code == 200, response.get_json()
+            assert list(appModule.exportRows(entity)) == expected
+
+def testBadRowRollsBackOnlyItsChunk(client, monkeypatch):
+    monkeypatch.setattr(appModule, 'bulkChunkSize', 2)
+    rows = [{'headline': 'h%d' % number, 'postedDate': 'd', 'articleBody': 'b'} for number in range(5)]
+
+    response = client.post('/bulk/news?format=ndjson', data=ndjson(rows[:3] + [rows[0]] + rows[4:]))
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('2 rows imported')
+    assert [news.headline for news in appModule.News.query.order_by(appModule.News.headline)] == ['h0', 'h1']
+
+    response = client.post('/bulk/news?format=ndjson', data=ndjson(rows[2:3] + [dict(rows[3], extra=1)] + rows[4:]))
+    assert response.status_code == 400
+    assert 'row 2: unknown fields extra' in response.get_json()['error']
+    assert appModule.News.query.count() == 2
@@ -0,0 +1,108 @@
+# ON DELETE rules without shards: what deleting investors, portfolios, companies and advisors takes with it, and what it refuses
+import pytest
+
+import app as appModule
+
+@pytest.fixture
+def client(tmp_path):
+    app = appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db.sqlite'), 'PASSWORD_WORKERS': 0,
+                                'PASSWORD_KDF': 'pbkdf2_sha256', 'PASSWORD_COST': 1000})
+    with app.app_context():
+        appModule.createTables()
+        yield app.test_client()
+
+def addAdvisor(client, name):
+    return client.post('/advisor', json={'name': name, 'username': name, 'password': 'p', 'qualifications': ['cfa']}).get_json()['advisorId']
+
+def addInvestor(client, name):
+    return client.post('/investor', json={'name': name, 'dateOfBirth': 'd', 'username': name, 'password': 'p'}).get_json()['investorId']
+
+def addPortfolio(client, investorId, ticker='ACM'):
+    holdings = [1.0] * 3
+    portfolioId = client.post('/portfolio', json={'investorId': investorId, 'bonds': holdings, 'canadianEquities': holdings, 'usEquities': holdings}).get_json()['portfolioId']
+    client.post('/portfolio/stock', json={'portfolioId': portfolioId, 'ticker': ticker, 'amount': 5})
+    return portfolioId
+
+def addCompany(client):
+    client.post('/company', json={'companyName': 'Acme', 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2})
+    client.post('/company/Acme/stock', json={'ticker': 'ACM', 'currentPrice': 1.0, 'targetPrice': 2.0})
+
+def rows(*models):
+    return {model.__tablename__: len(model.query.all()) for model in models}
+
+holdingModels = (appModule.Portfolio_Bond, appModule.Portfolio_Canadian_Equity, appModule.Portfolio_US_Equity, appModule.Consists_Of)
+
+def testDeletingAnInvestorLeavesNoOrphans(client):
+    addAdvisor(client, 'a')
+    addCompany(client)
+    investorId = addInvestor(client, 'i')
+    client.post('/investor/%d/survey' % investorId, json={'riskTolerance': 'low', 'monthlySavings': 1, 'cashBurn': 1, 'debt': 1, 'annualIncome': 1, 'preferenceOfIncome': 'x'})
+    addPortfolio(client, investorId)
+    appModule.db.session.add(appModule.Investment(None, investorId, 'ACM', 5.0))
+    appModule.db.session.commit()
+    client.post('/report', json={'referenceId': appModule.Investment.query.one().referenceId, 'weekly': 1, 'monthly': 1,
+                                 'quarterly': 1, 'annual': 1, 'fiveYear': 1, 'sinceInception': 1})
+    dependents = (appModule.Survey, appModule.Portfolio, appModule.Investment, appModule.Report) + holdingModels
+    assert all(count > 0 for count in rows(*dependents).values()), rows(*dependents)
+
+    assert client.delete('/investor/%d' % investorId).status_code == 200
+    appModule.db.session.remove()
+    assert set(rows(*dependents + (appModule.Investor,)).values()) == {0}
+    assert appModule.Account.query.filter_by(username = 'i').first() is None
+    assert appModule.Advisor.query.one().clientCount == 0
+    assert rows(appModule.Stock) == {'stock': 1}
+
+def testDeletingAPortfolioTakesItsHoldings(client):
+    addAdvisor(client, 'a')
+    addCompany(client)
+    investorId = addInvestor(client, 'i')
+    kept = addPortfolio(client, investorId)
+    deleted = addPortfolio(client, investorId)
+
+    assert client.delete('/portfolio/%d' % deleted).status_code == 200
+    appModule.db.session.remove()
+    for model in holdingModels:
+        assert {row.portfolioId for row in model.query} == {kept}
+
+def testHeldStocksAndOfferedCompaniesAreNotDeleted(client):
+    advisorId = addAdvisor(client, 'a')
+    addCompany(client)
+    portfolioId = addPortfolio(client, addInvestor(client, 'i'))
+
+    assert client.delete('/company/Acme/stock/ACM').status_code == 409
+    assert client.delete('/company/Acme').status_code == 409
+    appModule.db.session.remove()
+    assert rows(appModule.Company, appModule.Stock, appModule.Consists_Of) == {'company': 1, 'stock': 1, 'consists__of': 1}
+
+    client.delete('/portfolio/%d' % portfolioId)
+    client.post('/investment/options', json={'advisorId': advisorId, 'amount': 1, 'company': 'Acme', 'invType': 'stock'})
+    assert client.delete('/company/Acme').status_code == 409
+    client.delete('/advisor/%d' % advisorId)
+    assert client.delete('/company/Acme').status_code == 200
+    appModule.db.session.remove()
+    assert rows(appModule.Company, appModule.Stock) == {'company': 0, 'stock': 0}
+
+def testOffboardingMovesClientsToTheLeastBusyAdvisor(client):
+    leaving = addAdvisor(client, 'a')
+    busy = addAdvisor(client, 'b')
+    idle = addAdvisor(client, 'c')
+    investors = [addInvestor(client, 'i%d' % number) for number in range(5)]
+    assert [appModule.Investor.query.get(investorId).advisorId for investorId in investors] == [leaving, busy, idle, leaving, busy]
+    client.post('/investment/options', json={'advisorId': leaving, 'amount': 1, 'company': None, 'invType': 'bond'})
+
+    assert client.delete('/advisor/%d' % leaving).status_code == 200
+    appModule.db.session.remove()
+    assert [appModule.Investor.query.get(investorId).advisorId for investorId in investors] == [idle, busy, idle, idle, busy]
+    assert {advisor.advisorId: advisor.clientCount for advisor in appModule.Advisor.query} == {busy: 2, idle: 3}
+    assert rows(appModule.Investment_Option) == {'investment__option': 0}
+    assert [qualification.advisorId for qualification in appModule.Advisor_Qualification.query] == [busy, idle]
+    assert appModule.Account.query.filter_by(username = 'a').first() is None
+
+def testOffboardingToANamedAdvisor(client):
+    leaving = addAdvisor(client, 'a')
+    target = addAdvisor(client, 'b')
+    investorId = addInvestor(client, 'i')
+    assert client.delete('/advisor/%d?reassignTo=%d' % (leaving, leaving)).status_code == 400
+    assert client.delete('/advisor/%d?reassignTo=%d' % (leaving, target)).status_code == 200
+    appModule.db.session.remove()
+    assert appModule.Investor.query.get(investorId).advisorId == target
@@ -0,0 +1,162 @@
+# The change feed: renamed keys and the rows ON UPDATE CASCADE rewrites, limit bounds, long polls, server-sent
+# events, the per-log cursor of sharded mode and pruning
+import json
+import threading
+import time
+
+import pytest
+
+import app as appModule
+
+@pytest.fixture
+def client(tmp_path):
+    app = appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db.sqlite'), 'PASSWORD_WORKERS': 0})
+    with app.app_context():
+        appModule.createTables()
+        yield app.test_client()
+
+@pytest.fixture
+def shardedClient(tmp_path):
+    app = appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db.sqlite'), 'PASSWORD_WORKERS': 0,
+                                'SHARDS': 2, 'SHARD_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db-shard{}.sqlite')})
+    with app.app_context():
+        appModule.createTables()
+        yield app.test_client()
+
+def addCompany(client, name):
+    return client.post('/company', json={'companyName': name, 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2})
+
+def feed(client, since):
+    return [(change['op'], change['entity'], change['entityKey']) for change in client.get('/changes?since=%s&limit=5000' % since).get_json()['changes']]
+
+def testRenamesLogOldKeyAndCascadedRows(client):
+    client.post('/advisor', json={'name': 'a', 'username': 'a', 'password': 'p', 'qualifications': []})
+    investorId = client.post('/investor', json={'name': 'i', 'dateOfBirth': 'd', 'username': 'i', 'password': 'p'}).get_json()['investorId']
+    client.post('/company', json={'companyName': 'Acme', 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2})
+    client.post('/company/Acme/stock', json={'ticker': 'ACM', 'currentPrice': 1.0, 'targetPrice': 2.0})
+    portfolioId = client.post('/portfolio', json={'investorId': investorId, 'bonds': [], 'canadianEquities': [], 'usEquities': []}).get_json()['portfolioId']
+    client.post('/portfolio/stock', json={'portfolioId': portfolioId, 'ticker': 'ACM', 'amount': 5})
+    since = client.get('/changes?since=0&limit=5000').get_json()['next']
+
+    client.put('/company/Acme', json={'companyName': 'Acme2', 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2})
+    assert feed(client, since) == [('delete', 'company', '["Acme"]'), ('insert', 'company', '["Acme2"]'), ('update', 'stock', '["ACM"]')]
+
+    since = client.get('/changes?since=0&limit=5000').get_json()['next']
+    client.put('/company/Acme2/stock/ACM', json={'ticker': 'ACX', 'currentPrice': 1.0, 'targetPrice': 2.0})
+    assert feed(client, since) == [('delete', 'stock', '["ACM"]'), ('insert', 'stock', '["ACX"]'),
+                                   ('delete', 'consists_of', '[%d, "ACM"]' % portfolioId), ('insert', 'consists_of', '[%d, "ACX"]' % portfolioId)]
+
+def testLimitIsAtLeastOne(client):
+    for number in range(3):
+        client.post('/company', json={'companyName': 'C%d' % number, 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2})
+    assert len(client.get('/changes?since=0&limit=-1').get_json()['changes']) == 1
+    assert len(client.get('/changes?since=0&limit=0').get_json()['changes']) == 1
+
+def testLongPollAnswersWhenAChangeIsCommitted(client):
+    since = client.get('/changes?since=0').get_json()['next']
+    started = time.monotonic()
+    assert client.get('/changes?since=%s&wait=0.3' % since).get_json() == {'changes': [], 'next': since}
+    assert time.monotonic() - started >= 0.3
+
+    writer = threading.Timer(0.2, lambda: addCompany(client.application.test_client(), 'Acme'))
+    writer.start()
+    started = time.monotonic()
+    body = client.get('/changes?since=%s&wait=30' % since).get_json()
+    writer.join()
+    assert time.monotonic() - started < 5
+    assert [(change['op'], change['entityKey']) for change in body['changes']] == [('insert', '["Acme"]')]
+    assert body['next'] == body['changes'][0]['changeId']
+
+def events(client, count, **headers):
+    response = client.get('/changes', headers=dict(headers, Accept='text/event-stream'), buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    received = []
+    text = ''
+    for chunk in response.response:
+        text += chunk.decode() if isinstance(chunk, bytes) else chunk
+        while '\n\n' in text and len(received) < count:
+            event, text = text.split('\n\n', 1)
+            fields = dict(line.split(': ', 1) for line in event.splitlines())
+            received.append((fields['id'], json.loads(fields['data'])['entityKey']))
+        if len(received) == count:
+            break
+    response.close()
+    return received
+
+def testEventStreamResumesFromLastEventId(client):
+    for name in ('A', 'B', 'C'):
+        addCompany(client, name)
+    first, second = events(client, 2, **{'Last-Event-ID': '0'})
+    assert [key for eventId, key in (first, second)] == ['["A"]', '["B"]']
+
+    # a reconnecting client sends the id of the last event it saw and gets what came after it
+    assert events(client, 1, **{'Last-Event-ID': first[0]}) == [second]
+    addCompany(client, 'D')
+    assert [key for eventId, key in events(client, 2, **{'Last-Event-ID': second[0]})] == ['["C"]', '["D"]']
+
+def testShardedCursorHoldsOneChangeIdPerLog(shardedClient):
+    client = shardedClient
+    client.post('/advisor', json={'name': 'a', 'username': 'a', 'password': 'p', 'qualifications': []})
+    client.post('/advisor', json={'name': 'b', 'username': 'b', 'password': 'p', 'qualifications': []})
+    for name in ('i', 'j', 'k'):
+        client.post('/investor', json={'name': name, 'dateOfBirth': 'd', 'username': name, 'password': 'p'})
+    addCompany(client, 'Acme')
+
+    everything = client.get('/changes?since=0&limit=5000').get_json()
+    assert len(everything['next'].split(',')) == 3
+    assert {change['entity'] for change in everything['changes']} >= {'account', 'advisor', 'investor', 'company'}
+
+    # walking the feed one change at a time sees every change of every log once, in commit order
+    cursor, walked = '0', []
+    while True:
+        body = client.get('/changes?since=%s&limit=1' % cursor).get_json()
+        if not body['changes']:
+            break
+        walked += body['changes']
+        cursor = body['next']
+    assert walked == everything['changes']
+    assert cursor == everything['next']
+    assert client.get('/changes?since=1,x').status_code == 400
+
+def age(seconds):
+    for log in appModule.changeLogs():
+        appModule.Change.query.options(appModule.set_shard_id(log)).update({'changedAt': appModule.Change.changedAt - seconds}, synchronize_session=False)
+    appModule.db.session.commit()
+
+def changeIds(client):
+    return [change['changeId'] for change in client.get('/changes?since=0&limit=5000').get_json()['changes']]
+
+def testPruneKeepsRecentChangesAndTheNewestOfEachLog(client):
+    for name in ('A', 'B', 'C'):
+        addCompany(client, name)
+    age(3600)
+    addCompany(client, 'D')
+    runner = client.application.test_cli_runner()
+
+    result = runner.invoke(args=['prune-changes', '--older-than', '60'])
+    assert result.output == 'pruned 3 changes\n'
+    assert changeIds(client) == [4]
+
+    # the newest change survives even when it is old, so changeIds keep growing after a prune
+    age(3600)
+    assert runner.invoke(args=['prune-changes']).output == 'pruned 0 changes\n'
+    addCompany(client, 'E')
+    assert changeIds(client) == [4, 5]
+
+    client.application.config['CHANGE_RETENTION_SECONDS'] = 0
+    assert runner.invoke(args=['prune-changes']).output == 'change retention is off, nothing pruned\n'
+
+def testPruneCoversEveryShardLog(shardedClient):
+    client = shardedClient
+    client.post('/advisor', json={'name': 'a', 'username': 'a', 'password': 'p', 'qualifications': []})
+    for name in ('i', 'j'):
+        client.post('/investor', json={'name': name, 'dateOfBirth': 'd', 'username': name, 'password': 'p'})
+    before = client.get('/changes?since=0&limit=5000').get_json()['next']
+    age(3600)
+
+    assert client.application.test_cli_runner().invoke(args=['prune-changes', '--older-than', '60']).exit_code == 0
+    remaining = client.get('/changes?since=0&limit=5000').get_json()
+    written = [offset for offset in before.split(',') if offset != '0']
+    assert len(written) >= 2
+    assert remaining['next'] == before
+    assert sorted(str(change['changeId']) for change in remaining['changes']) == sorted(written)
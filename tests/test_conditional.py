@@ -0,0 +1,22 @@
+# 304 responses repeat the ETag and Vary of the 200 they validate, compressed or not
+import pytest
+
+import app as appModule
+
+@pytest.fixture
+def client(tmp_path):
+    app = appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db.sqlite'), 'PASSWORD_WORKERS': 0})
+    with app.app_context():
+        appModule.createTables()
+        for number in range(60):
+            app.test_client().post('/company', json={'companyName': 'C%d' % number, 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2})
+        yield app.test_client()
+
+@pytest.mark.parametrize('path, encoding', [('/company', 'gzip'), ('/company', 'identity'), ('/company/C1', 'gzip')])
+def testNotModifiedMatchesValidatedResponse(client, path, encoding):
+    response = client.get(path, headers={'Accept-Encoding': encoding})
+    assert response.status_code == 200
+    revalidated = client.get(path, headers={'Accept-Encoding': encoding, 'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == response.headers['ETag']
+    assert revalidated.headers.get('Vary') == response.headers.get('Vary') == 'Accept-Encoding'
@@ -0,0 +1,78 @@
+# The /market snapshot: industry bodies and how soon company and stock writes show up
+import pytest
+
+import app as appModule
+
+@pytest.fixture
+def client(tmp_path):
+    app = appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db.sqlite'), 'PASSWORD_WORKERS': 0})
+    with app.app_context():
+        appModule.createTables()
+        yield app.test_client()
+    app.extensions['marketSnapshot'].close()
+
+def addCompany(client, name, industry, marketCap):
+    client.post('/company', json={'companyName': name, 'industry': industry, 'sharesOutstanding': 1, 'marketCap': marketCap})
+
+def testIndustryKeepsItsCompanyCountNextToTheRows(client):
+    addCompany(client, 'Acme', 'tech', 2)
+    addCompany(client, 'Bolt', 'tech', 3)
+    client.post('/company/Acme/stock', json={'ticker': 'ACM', 'currentPrice': 1.0, 'targetPrice': 2.0})
+
+    industry = client.get('/market/industry/tech').get_json()
+    assert industry['companies'] == 2
+    assert industry['stocks'] == 1
+    assert industry['totalMarketCap'] == 5
+    assert [row['companyName'] for row in industry['rows']] == ['Acme', 'Bolt']
+    assert industry['rows'][0]['stocks'] == [{'ticker': 'ACM', 'currentPrice': 1.0, 'targetPrice': 2.0}]
+
+    snapshot = client.get('/market/snapshot').get_json()
+    assert snapshot['totals']['companies'] == 2
+    assert snapshot['industries'] == [industry]
+
+def testWritesInThisProcessShowUpOnTheNextRequest(client):
+    addCompany(client, 'Acme', 'tech', 2)
+    client.post('/company/Acme/stock', json={'ticker': 'ACM', 'currentPrice': 1.0, 'targetPrice': 2.0})
+    assert client.get('/market/snapshot').get_json()['totals']['companies'] == 1
+    # with the refresher stopped, only the request itself can apply the writes
+    client.application.extensions['marketSnapshot'].close()
+
+    addCompany(client, 'Bolt', 'energy', 3)
+    assert [industry['industry'] for industry in client.get('/market/snapshot').get_json()['industries']] == ['energy', 'tech']
+
+    client.put('/company/Acme', json={'companyName': 'Acme2', 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2})
+    rows = client.get('/market/industry/tech').get_json()['rows']
+    assert [(row['companyName'], [stock['ticker'] for stock in row['stocks']]) for row in rows] == [('Acme2', ['ACM'])]
+
+    client.delete('/company/Bolt')
+    assert client.get('/market/industry/energy').status_code == 404
+
+class FakeBrotli:
+    @staticmethod
+    def compress(data, quality):
+        return b'br:' + data
+
+@pytest.mark.parametrize('accept, expected', [('br', 'br'), ('gzip', 'gzip'), ('br, gzip', 'gzip'), ('identity', None)])
+def testSnapshotIsOnlySentInAnEncodingTheClientAccepts(client, monkeypatch, accept, expected):
+    monkeypatch.setattr(appModule, 'brotli', FakeBrotli)
+    client.application.config['COMPRESS_MIN_SIZE'] = 0
+    addCompany(client, 'Acme', 'tech', 2)
+    response = client.get('/market/snapshot', headers={'Accept-Encoding': accept})
+    assert response.headers.get('Content-Encoding') == expected
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+def testCompanyMovingIndustryLeavesOneAndJoinsTheOther(client):
+    addCompany(client, 'Acme', 'tech', 2)
+    addCompany(client, 'Bolt', 'tech', 3)
+    client.post('/company/Bolt/stock', json={'ticker': 'BLT', 'currentPrice': 1.0, 'targetPrice': 2.0})
+    client.post('/company/Bolt/stock', json={'ticker': 'BLX', 'currentPrice': 1.0, 'targetPrice': 3.0})
+    client.get('/market/snapshot')
+    client.application.extensions['marketSnapshot'].close()
+
+    client.put('/company/Bolt', json={'companyName': 'Bolt', 'industry': 'energy', 'sharesOutstanding': 1, 'marketCap': 3})
+    client.delete('/company/Bolt/stock/BLX')
+    tech = client.get('/market/industry/tech').get_json()
+    energy = client.get('/market/industry/energy').get_json()
+    assert (tech['companies'], tech['stocks'], tech['totalMarketCap']) == (1, 0, 2)
+    assert (energy['companies'], energy['stocks'], energy['averageUpside']) == (1, 1, 1.0)
+    assert [stock['ticker'] for stock in energy['rows'][0]['stocks']] == ['BLT']
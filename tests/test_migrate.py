@@ -0,0 +1,63 @@
+# Upgrading a database created before the ON DELETE rules, advisor.clientCount and the change/version tables
+import sqlite3
+
+import pytest
+
+import app as appModule
+
+# the tables as the app created them before, foreign keys without ON DELETE / ON UPDATE rules
+oldSchema = '''
+    DROP TABLE change;
+    DROP TABLE table__version;
+    DROP TABLE consists__of;
+    DROP TABLE stock;
+    DROP TABLE company;
+    DROP TABLE advisor;
+    CREATE TABLE company ("companyName" VARCHAR(50) PRIMARY KEY, industry VARCHAR(30), "sharesOutstanding" INTEGER, "marketCap" INTEGER);
+    CREATE TABLE stock (ticker VARCHAR(8) PRIMARY KEY, "currentPrice" FLOAT, "targetPrice" FLOAT,
+                        "companyName" VARCHAR(50) REFERENCES company ("companyName"));
+    CREATE TABLE consists__of ("portfolioId" INTEGER REFERENCES portfolio ("portfolioId"), "stockTicker" VARCHAR(8) REFERENCES stock (ticker),
+                               "numberOfStocks" INTEGER, PRIMARY KEY ("portfolioId", "stockTicker"));
+    CREATE TABLE advisor ("advisorId" INTEGER PRIMARY KEY, name VARCHAR(30), "accountId" INTEGER REFERENCES account ("accountId"));
+    INSERT INTO advisor VALUES (1, 'a', NULL);
+    INSERT INTO investor ("investorId", name, "advisorId") VALUES (1, 'i', 1), (2, 'j', 1);
+    INSERT INTO portfolio ("portfolioId", "investorId") VALUES (1, 1);
+    INSERT INTO company VALUES ('Acme', 'tech', 1, 2);
+    INSERT INTO stock VALUES ('ACM', 1.0, 2.0, 'Acme');
+    INSERT INTO consists__of VALUES (1, 'ACM', 5);
+'''
+
+@pytest.fixture
+def app(tmp_path):
+    path = tmp_path / 'db.sqlite'
+    app = appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(path), 'PASSWORD_WORKERS': 0})
+    with app.app_context():
+        appModule.createTables()
+        appModule.db.engine.dispose()
+    connection = sqlite3.connect(str(path))
+    connection.executescript(oldSchema)
+    connection.close()
+    app.config['path'] = str(path)
+    return app
+
+def testOldDatabaseBreaksWithoutMigration(app):
+    with app.app_context():
+        assert app.test_client().delete('/portfolio/1').status_code == 500
+
+def testMigrateRebuildsTablesAndKeepsRows(app):
+    result = app.test_cli_runner().invoke(args=['init-db', '--migrate'])
+    assert result.exit_code == 0, result.output
+    assert 'warning' not in result.output
+
+    connection = sqlite3.connect(app.config['path'])
+    assert connection.execute('SELECT "advisorId", "clientCount" FROM advisor').fetchall() == [(1, 2)]
+    assert connection.execute('SELECT * FROM consists__of').fetchall() == [(1, 'ACM', 5)]
+
+    with app.app_context():
+        client = app.test_client()
+        assert client.get('/company').status_code == 200
+        assert client.delete('/company/Acme').status_code == 409
+        assert client.delete('/portfolio/1').status_code == 200
+        assert connection.execute('SELECT count(*) FROM consists__of').fetchone() == (0,)
+        assert client.delete('/company/Acme').status_code == 200
+    assert connection.execute('SELECT count(*) FROM stock').fetchone() == (0,)
@@ -0,0 +1,74 @@
+# Password hashing: /login, rehashing plaintext and outdated hashes, the busy limit and PASSWORD_COST checks
+import pytest
+
+import app as appModule
+
+def makeApp(path, **config):
+    # cheap costs and no pool, the tests are about which hash gets stored and not how long it takes
+    settings = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(path), 'PASSWORD_WORKERS': 0,
+                'PASSWORD_KDF': 'pbkdf2_sha256', 'PASSWORD_COST': 1000}
+    settings.update(config)
+    app = appModule.create_app(settings)
+    with app.app_context():
+        appModule.createTables()
+    return app
+
+def storedPassword(app, username):
+    with app.app_context():
+        return appModule.Account.query.filter_by(username = username).one().password
+
+def login(client, username, password):
+    return client.post('/login', json={'username': username, 'password': password})
+
+@pytest.fixture
+def app(tmp_path):
+    return makeApp(tmp_path / 'db.sqlite')
+
+def testLogin(app):
+    client = app.test_client()
+    client.post('/investor', json={'name': 'i', 'dateOfBirth': 'd', 'username': 'i', 'password': 'secret'})
+    assert storedPassword(app, 'i').startswith('pbkdf2_sha256$1000$')
+
+    response = login(client, 'i', 'secret')
+    assert response.status_code == 200
+    assert response.get_json() == {'accountId': 1, 'username': 'i', 'isAdvisor': False}
+    assert login(client, 'i', 'wrong').status_code == 401
+    assert login(client, 'nobody', 'secret').status_code == 401
+
+def testPlaintextPasswordIsHashedOnLogin(app):
+    with app.app_context():
+        appModule.db.session.add(appModule.Account('old', 'secret', False))
+        appModule.db.session.commit()
+
+    client = app.test_client()
+    assert login(client, 'old', 'wrong').status_code == 401
+    assert storedPassword(app, 'old') == 'secret'
+    assert login(client, 'old', 'secret').status_code == 200
+    assert storedPassword(app, 'old').startswith('pbkdf2_sha256$1000$')
+    assert login(client, 'old', 'secret').status_code == 200
+
+@pytest.mark.parametrize('kdf, cost, prefix', [('pbkdf2_sha256', 2000, 'pbkdf2_sha256$2000$'), ('scrypt', 16, 'scrypt$16$')])
+def testOutdatedHashIsReplacedOnLogin(tmp_path, kdf, cost, prefix):
+    before = makeApp(tmp_path / 'db.sqlite')
+    before.test_client().post('/investor', json={'name': 'i', 'dateOfBirth': 'd', 'username': 'i', 'password': 'secret'})
+
+    after = makeApp(tmp_path / 'db.sqlite', PASSWORD_KDF=kdf, PASSWORD_COST=cost)
+    assert login(after.test_client(), 'i', 'secret').status_code == 200
+    assert storedPassword(after, 'i').startswith(prefix)
+    assert login(after.test_client(), 'i', 'secret').status_code == 200
+
+def testBusyHasherAnswers503(tmp_path):
+    app = makeApp(tmp_path / 'db.sqlite', PASSWORD_MAX_PENDING=1, PASSWORD_WAIT=0.01)
+    slots = app.extensions['passwordHasher'].slots
+    slots.acquire()
+    try:
+        response = login(app.test_client(), 'i', 'secret')
+    finally:
+        slots.release()
+    assert response.status_code == 503
+    assert login(app.test_client(), 'i', 'secret').status_code == 401
+
+@pytest.mark.parametrize('kdf, cost', [('scrypt', 1000), ('scrypt', 1), ('scrypt', 2 ** 16), ('pbkdf2_sha256', -1)])
+def testInvalidCostIsRejectedAtStartup(kdf, cost):
+    with pytest.raises(ValueError, match='PASSWORD_COST'):
+        appModule.create_app({'PASSWORD_KDF': kdf, 'PASSWORD_COST': cost})
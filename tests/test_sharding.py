@@ -0,0 +1,101 @@
+# Sharded mode: signups that fail between the two commits, and offboarding when no advisor shares the shard
+import pytest
+from sqlalchemy import event
+
+import app as appModule
+
+@pytest.fixture
+def app(tmp_path):
+    app = appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db.sqlite'), 'PASSWORD_WORKERS': 0,
+                                'SHARDS': 2, 'SHARD_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db-shard{}.sqlite')})
+    with app.app_context():
+        appModule.createTables()
+        yield app
+
+def addAdvisor(client, name):
+    return client.post('/advisor', json={'name': name, 'username': name, 'password': 'p', 'qualifications': []}).get_json()['advisorId']
+
+def signup(client, name):
+    return client.post('/investor', json={'name': name, 'dateOfBirth': 'd', 'username': name, 'password': 'p'})
+
+@pytest.mark.parametrize('failingBind', [None, 'shard1'])
+def testSignupFailingBetweenCommitsLeavesNothingBehind(app, failingBind):
+    client = app.test_client()
+    advisorId = addAdvisor(client, 'a')
+    assert appModule.shardOfAdvisor(advisorId) == 'shard1'
+
+    failures = []
+    def failOnce(connection):
+        if not failures:
+            failures.append(connection)
+            raise RuntimeError('disk full')
+    engine = appModule.db.engines[failingBind]
+    event.listen(engine, 'commit', failOnce)
+    try:
+        assert signup(client, 'i').status_code == 500
+    finally:
+        event.remove(engine, 'commit', failOnce)
+
+    appModule.db.session.remove()
+    assert failures
+    assert appModule.Account.query.filter_by(username = 'i').first() is None
+    assert appModule.Investor.query.all() == []
+    assert appModule.Advisor.query.get(advisorId).clientCount == 0
+    assert signup(client, 'i').status_code == 200
+
+def testOffboardingRefusesToStrandClientsOnTheirShard(app):
+    client = app.test_client()
+    first = addAdvisor(client, 'a')
+    addAdvisor(client, 'b')
+    investorId = signup(client, 'i').get_json()['investorId']
+    assert appModule.Investor.query.get(investorId).advisorId == first
+
+    response = client.delete('/advisor/%d' % first)
+    assert response.status_code == 409
+    assert appModule.Advisor.query.get(first) is not None
+
+    third = addAdvisor(client, 'c')
+    assert appModule.shardOfAdvisor(third) == appModule.shardOfAdvisor(first)
+    assert client.delete('/advisor/%d' % first).status_code == 200
+    appModule.db.session.remove()
+    assert appModule.Investor.query.get(investorId).advisorId == third
+    assert appModule.Advisor.query.get(third).clientCount == 1
+
+def testOffboardingTheLastAdvisorLeavesClientsUnassigned(app):
+    client = app.test_client()
+    advisorId = addAdvisor(client, 'a')
+    investorId = signup(client, 'i').get_json()['investorId']
+    assert client.delete('/advisor/%d' % advisorId).status_code == 200
+    appModule.db.session.remove()
+    assert appModule.Investor.query.get(investorId).advisorId is None
+
+def testWritesOnlyCommitTheShardsTheyTouch(app):
+    client = app.test_client()
+    addAdvisor(client, 'a')
+    investorId = signup(client, 'i').get_json()['investorId']
+
+    committed = []
+    listeners = [(engine, lambda connection, bind=bind: committed.append(bind)) for bind, engine in appModule.db.engines.items()]
+    for engine, listener in listeners:
+        event.listen(engine, 'commit', listener)
+    try:
+        client.post('/portfolio', json={'investorId': investorId, 'bonds': [1.0], 'canadianEquities': [], 'usEquities': []})
+    finally:
+        for engine, listener in listeners:
+            event.remove(engine, 'commit', listener)
+    assert set(committed) == {appModule.shardOfId(investorId)}
+
+def testHeldStockIsNotDeletedFromTheMainDatabase(app):
+    client = app.test_client()
+    addAdvisor(client, 'a')
+    investorId = signup(client, 'i').get_json()['investorId']
+    client.post('/company', json={'companyName': 'Acme', 'industry': 'tech', 'sharesOutstanding': 1, 'marketCap': 2})
+    client.post('/company/Acme/stock', json={'ticker': 'ACM', 'currentPrice': 1.0, 'targetPrice': 2.0})
+    portfolioId = client.post('/portfolio', json={'investorId': investorId, 'bonds': [], 'canadianEquities': [], 'usEquities': []}).get_json()['portfolioId']
+    client.post('/portfolio/stock', json={'portfolioId': portfolioId, 'ticker': 'ACM', 'amount': 5})
+
+    assert client.delete('/company/Acme').status_code == 409
+    appModule.db.session.remove()
+    assert appModule.Stock.query.get('ACM') is not None
+    assert client.delete('/portfolio/%d' % portfolioId).status_code == 200
+    assert client.delete('/company/Acme').status_code == 200
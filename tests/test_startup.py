@@ -0,0 +1,73 @@
+# Startup cost of the app: how long `import app` takes (with a per-module profile from -X importtime)
+# and how long create_app() takes. Neither may open a database connection.
+import gc
+import os
+import subprocess
+import sys
+import time
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import app as appModule
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# about twice what they take on a developer machine: `import app` ~0.9s, most of it Flask and SQLAlchemy,
+# of which the module body itself (models, schemas, routes) ~0.08s, and create_app 0.03-0.06s
+importBudgetSeconds = 2.0
+moduleBodyBudgetSeconds = 0.2
+createAppBudgetSeconds = 0.15
+
+# loaded on first use, not at startup: the hashing pool, and pyarrow for parquet
+deferredModules = ('concurrent.futures.process', 'multiprocessing.pool', 'pyarrow')
+
+# (cumulative microseconds, self microseconds, module) for every module imported by `import app`, slowest first
+def importProfile():
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=repoDir,
+                            capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        selfTime, cumulative, module = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), int(selfTime), module.strip()))
+    return sorted(modules, reverse=True)
+
+def testImportTime():
+    modules = importProfile()
+    times = {module: (cumulative, selfTime) for cumulative, selfTime, module in modules}
+    total, body = times['app'][0] / 1e6, times['app'][1] / 1e6
+    print('\nimport app: %.3fs, module body %.3fs' % (total, body))
+    for cumulative, selfTime, module in modules[:10]:
+        print('  %8.1fms  %s' % (cumulative / 1000, module))
+    assert total < importBudgetSeconds
+    assert body < moduleBodyBudgetSeconds
+    assert [module for module in deferredModules if module in times] == []
+
+def testCreateAppTime():
+    connections = []
+    listener = lambda connection, record: connections.append(connection)
+    event.listen(Engine, 'connect', listener)
+    try:
+        # a database that cannot exist, create_app must not touch it
+        config = {'SQLALCHEMY_DATABASE_URI': 'sqlite:////nonexistent/startup/db.sqlite'}
+        started = time.perf_counter()
+        app = appModule.create_app(config)
+        elapsed = time.perf_counter() - started
+        print('\ncreate_app: %.1fms' % (elapsed * 1000))
+    finally:
+        event.remove(Engine, 'connect', listener)
+
+    assert elapsed < createAppBudgetSeconds
+    assert connections == []
+    assert 'investor' in app.blueprints
+
+def testAppsAreNotKeptAliveByProcessHooks():
+    apps = [appModule.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}) for number in range(3)]
+    assert all(app in appModule.liveApps for app in apps)
+    references = [weakref.ref(app) for app in apps]
+    del apps
+    gc.collect()
+    assert [reference() for reference in references] == [None] * 3
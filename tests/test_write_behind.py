@@ -0,0 +1,61 @@
+# The write-behind contract of saveRow: status codes, backpressure, timeouts, and close() flushing the queue
+import pytest
+
+import app as appModule
+
+def makeClient(tmp_path, **config):
+    settings = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db.sqlite'), 'PASSWORD_WORKERS': 0, 'WRITE_BEHIND': True}
+    settings.update(config)
+    app = appModule.create_app(settings)
+    with app.app_context():
+        appModule.createTables()
+    return app.test_client()
+
+def postNews(client, headline, query=''):
+    return client.post('/news' + query, json={'headline': headline, 'postedDate': 'd', 'articleBody': 'b'})
+
+def headlines(client):
+    with client.application.app_context():
+        return sorted(news.headline for news in appModule.News.query)
+
+@pytest.fixture
+def stalledQueue(monkeypatch):
+    # without a writer thread nothing leaves the queue
+    monkeypatch.setattr(appModule.WriteBehindQueue, 'start', lambda queue: None)
+
+def testAcceptedWithoutWaitAndCommittedWithWait(tmp_path):
+    client = makeClient(tmp_path)
+    response = postNews(client, 'queued')
+    assert response.status_code == 202
+    assert response.get_json()['headline'] == 'queued'
+
+    response = postNews(client, 'waited', '?wait=1')
+    assert response.status_code == 200
+    assert 'waited' in headlines(client)
+    client.application.extensions['writeQueue'].close()
+
+def testConflictIsReportedWhenWaiting(tmp_path):
+    client = makeClient(tmp_path)
+    assert postNews(client, 'same', '?wait=1').status_code == 200
+    response = postNews(client, 'same', '?wait=1')
+    assert response.status_code == 409
+    assert 'conflicts' in response.get_json()['error']
+    client.application.extensions['writeQueue'].close()
+
+def testFullQueueAnswers503(tmp_path, stalledQueue):
+    client = makeClient(tmp_path, WRITE_BEHIND_QUEUE_SIZE=1, WRITE_BEHIND_PUT_TIMEOUT=0.01)
+    assert postNews(client, 'first').status_code == 202
+    assert postNews(client, 'second').status_code == 503
+
+def testWaitTimesOutWith504(tmp_path, stalledQueue):
+    client = makeClient(tmp_path, WRITE_BEHIND_WAIT_TIMEOUT=0.05)
+    assert postNews(client, 'slow', '?wait=1').status_code == 504
+
+def testCloseFlushesQueuedRows(tmp_path):
+    # a long batch window keeps the rows queued until close() ends it
+    client = makeClient(tmp_path, WRITE_BEHIND_BATCH_MS=60000)
+    for number in range(20):
+        assert postNews(client, 'h%02d' % number).status_code == 202
+    assert headlines(client) == []
+    client.application.extensions['writeQueue'].close()
+    assert headlines(client) == ['h%02d' % number for number in range(20)]